@@ -2,6 +2,6 @@
 
 __version__ = "0.1.0"
 
-from .cli import flatten_pdf
+from .cli import flatten_bytes, flatten_pdf
 
-__all__ = ["flatten_pdf"]
+__all__ = ["flatten_bytes", "flatten_pdf"]
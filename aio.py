@@ -0,0 +1,368 @@
+"""Flattening from asyncio code without blocking the event loop.
+
+``flatten_pdf_async`` renders and encodes pages on a process pool shared by
+every caller, and runs Poppler's pdftoppm with
+``asyncio.create_subprocess_exec``. A process-wide limit bounds how many
+documents are flattened at once, however many coroutines ask for it.
+"""
+
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+
+from .cli import (
+    BACKEND,
+    BAND_PIXELS,
+    BILEVEL,
+    DPI,
+    GRAYSCALE,
+    MAX_PIXELS,
+    PAGES_PER_JOB,
+    check_input,
+    check_modes,
+    encode_page,
+    get_pixel_budget,
+    get_poppler_path,
+    get_page_sizes,
+    get_renderer,
+    insert_encoded_page,
+    is_pdf_data,
+    logger,
+    plan_batches,
+    plan_page_dpis,
+    render_page_range,
+    resolve_dates,
+    save_flattened_pdf,
+    set_file_times,
+)
+
+# Documents flattened at once, and worker processes rendering their pages
+CONCURRENCY = os.cpu_count() or 1
+
+_concurrency = CONCURRENCY
+_executor = None
+# Flattens using each worker pool; a pool replaced by `set_concurrency` is
+# shut down once the last of them finishes
+_executor_users = {}
+_executor_lock = threading.RLock()
+# MuPDF isn't thread-safe, so documents opened in the parent's threads take turns
+_mupdf_lock = threading.Lock()
+# asyncio primitives belong to one event loop, so each loop gets its own
+# semaphore of `_concurrency` slots
+_limits = weakref.WeakKeyDictionary()
+
+
+def set_concurrency(concurrency):
+    """Change how many documents may be flattened at once in this process.
+
+    Flattens already running keep their slots and worker pool; new ones use
+    the new limit. The old pool is shut down when the last of them finishes.
+    """
+    global _concurrency, _executor
+
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    with _executor_lock:
+        _concurrency = concurrency
+        _limits.clear()
+        executor, _executor = _executor, None
+        if executor is not None and not _executor_users.get(executor):
+            executor.shutdown(wait=False)
+
+
+def get_limit():
+    """Return the semaphore bounding concurrent flattens on the running loop."""
+    loop = asyncio.get_running_loop()
+    limit = _limits.get(loop)
+    if limit is None:
+        limit = _limits[loop] = asyncio.Semaphore(_concurrency)
+    return limit
+
+
+def get_executor():
+    """Return the process pool shared by all flattens, starting it on first use."""
+    global _executor
+    from concurrent.futures import ProcessPoolExecutor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=_concurrency)
+        return _executor
+
+
+def acquire_executor():
+    """Return the shared process pool, kept running until `release_executor`."""
+    with _executor_lock:
+        executor = get_executor()
+        _executor_users[executor] = _executor_users.get(executor, 0) + 1
+    return executor
+
+
+def release_executor(executor):
+    """Stop using `executor`, shutting it down if it has since been replaced."""
+    with _executor_lock:
+        _executor_users[executor] -= 1
+        if _executor_users[executor]:
+            return
+        del _executor_users[executor]
+        if executor is _executor:
+            return
+    executor.shutdown(wait=False)
+
+
+def discard_executor(executor):
+    """Stop handing out `executor` after one of its workers died.
+
+    Flattens still using it fail; it is shut down when the last of them
+    calls `release_executor`, and the next flatten starts a new pool.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+
+def shutdown():
+    """Stop the shared worker processes, e.g. when the application exits."""
+    global _executor
+
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def pdftoppm_executable():
+    poppler_path = get_poppler_path()
+    return os.path.join(poppler_path, "pdftoppm") if poppler_path else "pdftoppm"
+
+
+async def run_pdftoppm(args):
+    """Run pdftoppm with `args`, killing it if the calling task is cancelled."""
+    process = await asyncio.create_subprocess_exec(
+        pdftoppm_executable(),
+        *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await process.communicate()
+    except BaseException:
+        # Cancelled (or interrupted): don't leave pdftoppm rendering in the background
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode:
+        raise RuntimeError(
+            f"pdftoppm exited with status {process.returncode}: "
+            f"{stderr.decode(errors='replace').strip()}"
+        )
+
+
+def rendered_files(directory):
+    """Return the pages pdftoppm wrote to `directory`, in page order."""
+    # pdftoppm names pages ROOT-N.ppm, zero-padding N to the page count's width
+    return sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory)),
+        key=lambda path: int(os.path.splitext(path)[0].rsplit("-", 1)[1]),
+    )
+
+
+def encode_rendered_files(paths, first_page, dpi, bilevel, grayscale):
+    """Encode pages rendered to files by pdftoppm; runs inside worker processes.
+
+    Returns `(data, info)` pairs like `cli.iter_page_range` and removes the
+    files once they are encoded.
+    """
+    from PIL import Image
+
+    pages = []
+    for number, path in enumerate(paths, start=first_page):
+        start = time.perf_counter()
+        with Image.open(path) as image:
+            image.load()
+            loaded = time.perf_counter()
+            data, quality = encode_page(image, bilevel=bilevel, grayscale=grayscale)
+        os.remove(path)
+        pages.append((
+            data,
+            {
+                "page": number,
+                "dpi": dpi,
+                "render_seconds": loaded - start,
+                "encode_seconds": time.perf_counter() - loaded,
+                "bytes": len(data),
+                "quality": quality,
+            },
+        ))
+    return pages
+
+
+async def run_mupdf(function, *args):
+    """Run `function` on a thread, holding the lock on MuPDF in this process."""
+
+    def locked():
+        with _mupdf_lock:
+            return function(*args)
+
+    return await asyncio.to_thread(locked)
+
+
+def insert_pages(doc, pages, sizes, stats):
+    """Add a batch of `(data, info)` pairs to `doc` and their timings to `stats`.
+
+    Pages get their size in points from `sizes`, as in `cli.get_page_sizes`.
+    """
+    for data, info in pages:
+        stats.add_page(info)
+        insert_encoded_page(doc, data, sizes[info["page"] - 1])
+
+
+async def flatten_pdf_async(
+    pdf_path,
+    output_path,
+    creation_date=None,
+    modification_date=None,
+    dpi=DPI,
+    backend=BACKEND,
+    max_pixels=MAX_PIXELS,
+    max_memory_mb=None,
+    bilevel=BILEVEL,
+    grayscale=GRAYSCALE,
+    band_pixels=BAND_PIXELS,
+):
+    """Flatten `pdf_path` into an image-only PDF at `output_path` from a coroutine.
+
+    Takes the same rendering options as `cli.flatten_pdf`; `pdf_path` may be
+    the bytes of a PDF and `output_path` a binary file object. Caching is not
+    supported. At most `CONCURRENCY` documents (see `set_concurrency`) are
+    flattened at once, and the others wait for a free slot.
+
+    Pages are rendered and encoded `PAGES_PER_JOB` at a time on the shared
+    worker pool. With the Poppler backend, pdftoppm renders the next batch
+    to a temporary directory while workers encode the previous one. Only a
+    bounded number of batches is in flight at once, and finished pages are
+    added to the document in this process as they arrive, so neither
+    rendered nor encoded pages pile up.
+
+    Cancelling the task kills a running pdftoppm and drops pages not yet
+    started. A save already under way runs to completion, so a cancellation
+    during it may still leave the output behind.
+
+    Returns a `stats.FlattenStats` with the DPI and timings of every page
+    and the sizes. Stage times are not recorded, since concurrent flattens
+    share the process.
+    """
+    from .stats import FlattenStats
+
+    check_input(pdf_path)
+    check_modes(bilevel, grayscale)
+    get_renderer(backend)
+    max_pixels = get_pixel_budget(max_pixels, max_memory_mb)
+    stats = FlattenStats(dpi)
+    stats.input_bytes = len(pdf_path) if is_pdf_data(pdf_path) else os.path.getsize(pdf_path)
+
+    async with get_limit():
+        import fitz
+
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        in_flight = 2 * _concurrency
+        doc = None
+
+        async def finish_oldest():
+            await run_mupdf(insert_pages, doc, await pending.popleft(), sizes, stats)
+
+        async def submit(function, *args):
+            pending.append(loop.run_in_executor(executor, function, *args))
+            if len(pending) >= in_flight:
+                await finish_oldest()
+
+        workdir = await asyncio.to_thread(tempfile.mkdtemp, prefix="pdf-flattener-")
+        executor = acquire_executor()
+        try:
+            if is_pdf_data(pdf_path):
+                # Workers and pdftoppm open the document themselves
+                input_path = os.path.join(workdir, "input.pdf")
+                await asyncio.to_thread(write_file, input_path, pdf_path)
+            else:
+                input_path = pdf_path
+            creation_dt, modification_dt = await run_mupdf(
+                resolve_dates, pdf_path, creation_date, modification_date
+            )
+            dpis = await run_mupdf(plan_page_dpis, input_path, dpi, max_pixels)
+            sizes = await run_mupdf(get_page_sizes, input_path)
+            doc = await run_mupdf(fitz.open)
+
+            if backend == "poppler":
+                for first_page, last_page, batch_dpi in plan_batches(1, dpis, PAGES_PER_JOB):
+                    directory = os.path.join(workdir, f"pages-{first_page}")
+                    os.mkdir(directory)
+                    args = ["-r", str(batch_dpi), "-f", str(first_page), "-l", str(last_page)]
+                    if grayscale == "force":
+                        args.append("-gray")
+                    await run_pdftoppm([*args, input_path, os.path.join(directory, "page")])
+                    await submit(
+                        encode_rendered_files,
+                        rendered_files(directory),
+                        first_page,
+                        batch_dpi,
+                        bilevel,
+                        grayscale,
+                    )
+            else:
+                options = (dpi, backend, max_pixels, bilevel, grayscale, band_pixels)
+                for first_page in range(1, len(dpis) + 1, PAGES_PER_JOB):
+                    last_page = min(first_page + PAGES_PER_JOB - 1, len(dpis))
+                    await submit(render_page_range, input_path, first_page, last_page, *options)
+            while pending:
+                await finish_oldest()
+
+            data = await run_mupdf(
+                save_flattened_pdf, doc, output_path, creation_dt, modification_dt
+            )
+            if data is None:
+                await asyncio.to_thread(
+                    set_file_times, output_path, creation_dt, modification_dt
+                )
+                stats.output_bytes = os.path.getsize(output_path)
+            else:
+                stats.output_bytes = len(data)
+        except BrokenProcessPool as e:
+            logger.error(f"Failed to flatten PDF: a worker process died: {e}")
+            discard_executor(executor)
+            raise
+        except Exception as e:
+            logger.error(f"Failed to flatten PDF: {e}")
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+            release_executor(executor)
+            if doc is not None:
+                # After a save that outlived a cancellation, not during it
+                await run_mupdf(doc.close)
+            await asyncio.to_thread(shutil.rmtree, workdir, ignore_errors=True)
+
+    return stats
+
+
+async def flatten_bytes_async(data, **options):
+    """Flatten a PDF held in memory and return the flattened PDF as bytes."""
+    output = io.BytesIO()
+    await flatten_pdf_async(data, output, **options)
+    return output.getvalue()
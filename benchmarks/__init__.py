@@ -0,0 +1,4 @@
+"""Speed and memory benchmarks of the flattening pipeline.
+
+Run with ``python -m pdf_flattener.benchmarks``.
+"""
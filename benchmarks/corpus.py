@@ -0,0 +1,268 @@
+"""Deterministic synthetic PDFs for benchmarking.
+
+Documents are built with PyMuPDF from a seeded random generator, so the
+same parameters and seed always give byte-identical files and no customer
+documents need to be shipped. Generate a named corpus with
+``python -m pdf_flattener.benchmarks.corpus NAME --output DIR``.
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+
+SEED = 0
+# Page sizes in points
+PAGE_SIZES = {
+    "letter": (612, 792),
+    "a4": (595, 842),
+    "legal": (612, 1008),
+    "tabloid": (792, 1224),
+    "poster": (24 * 72, 36 * 72),
+}
+# Fixed annotation dates so the output doesn't depend on the clock
+ANNOTATION_DATE = "D:20000101000000+00'00'"
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his "
+    "from at which but have an had they you were their one all we can her has there "
+    "been if more when will would who so no agreement court exhibit filed pursuant "
+    "section defendant plaintiff motion order page record hereby schedule total"
+).split()
+MARGIN = 54
+
+# Named corpora: file name -> generate_document arguments
+CORPORA = {
+    "small": {
+        "text.pdf": {"pages": 10, "text_density": 0.8},
+        "mixed.pdf": {"pages": 10, "text_density": 0.4, "drawings": 200, "photos": 1},
+        "forms.pdf": {"pages": 4, "text_density": 0.3, "form_fields": 8, "annotations": 4},
+    },
+    # Worst cases
+    "long-text": {"text-2000.pdf": {"pages": 2000, "text_density": 1.0}},
+    "posters": {
+        "posters-50.pdf": {
+            "pages": 50,
+            "page_size": "poster",
+            "text_density": 0.2,
+            "drawings": 2000,
+            "photos": 2,
+        },
+    },
+    "scans": {
+        "scans-200.pdf": {
+            "pages": 200,
+            "text_density": 0,
+            "photos": 1,
+            "photo_coverage": 1.0,
+        },
+    },
+}
+
+
+def photo(rng, width, height):
+    """Return JPEG bytes of a smooth, photo-like color image."""
+    from PIL import Image
+
+    # Upscaling a tiny random image gives soft gradients rather than noise
+    small = Image.frombytes("RGB", (16, 16), rng.randbytes(16 * 16 * 3))
+    image = small.resize((width, height), Image.Resampling.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def add_text(page, rng, density):
+    """Fill `density` (0 to 1) of the page's lines with random words."""
+    size = 10
+    leading = 1.4
+    lines = int((page.rect.height - 2 * MARGIN) / (size * leading))
+    chars = int((page.rect.width - 2 * MARGIN) / (size * 0.5))
+    text = []
+    for _ in range(lines):
+        words = []
+        if rng.random() < density:
+            while sum(len(word) + 1 for word in words) < chars:
+                words.append(rng.choice(WORDS))
+        text.append(" ".join(words[:-1]))
+    # One call per page; skipped lines stay empty
+    page.insert_text((MARGIN, MARGIN + size), text, fontsize=size, lineheight=leading)
+
+
+def add_drawings(page, rng, count):
+    """Draw `count` random lines, curves and filled shapes."""
+    import fitz
+
+    rect = page.rect
+    shape = page.new_shape()
+
+    def point():
+        return fitz.Point(rng.uniform(0, rect.width), rng.uniform(0, rect.height))
+
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5:
+            shape.draw_line(point(), point())
+        elif kind < 0.8:
+            shape.draw_bezier(point(), point(), point(), point())
+        else:
+            start = point()
+            shape.draw_rect(fitz.Rect(start, start + (rng.uniform(5, 80), rng.uniform(5, 80))))
+        shape.finish(
+            color=(rng.random(), rng.random(), rng.random()),
+            fill=(rng.random(), rng.random(), rng.random()) if kind >= 0.8 else None,
+            width=rng.uniform(0.2, 2),
+        )
+    shape.commit()
+
+
+def add_photos(page, rng, count, coverage):
+    """Place `count` photos, each covering about `coverage` of the page area."""
+    import fitz
+
+    rect = page.rect
+    scale = coverage ** 0.5
+    for _ in range(count):
+        width, height = rect.width * scale, rect.height * scale
+        x = rng.uniform(0, rect.width - width)
+        y = rng.uniform(0, rect.height - height)
+        # Roughly 150 DPI, like a typical scan
+        data = photo(rng, max(16, int(width * 150 / 72)), max(16, int(height * 150 / 72)))
+        page.insert_image(fitz.Rect(x, y, x + width, y + height), stream=data)
+
+
+def add_form_fields(page, rng, count, number):
+    """Add `count` text fields and check boxes with values filled in."""
+    import fitz
+
+    for index in range(count):
+        top = MARGIN + index * 36
+        widget = fitz.Widget()
+        widget.field_name = f"page{number}_field{index}"
+        if rng.random() < 0.7:
+            widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+            widget.rect = fitz.Rect(page.rect.width / 2, top, page.rect.width - MARGIN, top + 24)
+            widget.field_value = " ".join(rng.choice(WORDS) for _ in range(3))
+        else:
+            widget.field_type = fitz.PDF_WIDGET_TYPE_CHECKBOX
+            widget.rect = fitz.Rect(page.rect.width / 2, top, page.rect.width / 2 + 18, top + 18)
+            widget.field_value = rng.random() < 0.5
+        page.add_widget(widget)
+
+
+def add_annotations(page, rng, count):
+    """Add a mix of notes, free text, rectangles and highlights."""
+    import fitz
+
+    rect = page.rect
+    for _ in range(count):
+        x = rng.uniform(MARGIN, rect.width - 200)
+        y = rng.uniform(MARGIN, rect.height - 100)
+        kind = rng.randrange(4)
+        if kind == 0:
+            annot = page.add_text_annot((x, y), rng.choice(WORDS))
+        elif kind == 1:
+            annot = page.add_freetext_annot(
+                fitz.Rect(x, y, x + 180, y + 40), " ".join(rng.choice(WORDS) for _ in range(6))
+            )
+        elif kind == 2:
+            annot = page.add_rect_annot(fitz.Rect(x, y, x + 150, y + 80))
+        else:
+            annot = page.add_highlight_annot(fitz.Rect(x, y, x + 150, y + 12))
+        annot.set_info(creationDate=ANNOTATION_DATE, modDate=ANNOTATION_DATE)
+        annot.update()
+
+
+def generate_document(
+    path,
+    pages=10,
+    page_size="letter",
+    text_density=0.8,
+    drawings=0,
+    photos=0,
+    photo_coverage=0.25,
+    form_fields=0,
+    annotations=0,
+    seed=SEED,
+):
+    """Write a synthetic PDF to `path`.
+
+    `page_size` is a name from PAGE_SIZES or a `(width, height)` tuple in
+    points. `text_density` is the share of lines holding text; `drawings`,
+    `photos`, `form_fields` and `annotations` are counts per page. The
+    output is identical for identical arguments.
+    """
+    import fitz
+
+    if pages < 1:
+        raise ValueError("pages must be at least 1")
+    if isinstance(page_size, str):
+        try:
+            page_size = PAGE_SIZES[page_size]
+        except KeyError:
+            raise ValueError(
+                f"Unknown page size: {page_size}. Choose one of: {', '.join(PAGE_SIZES)}"
+            ) from None
+    width, height = page_size
+    rng = random.Random(seed)
+
+    doc = fitz.open()
+    try:
+        for number in range(pages):
+            page = doc.new_page(width=width, height=height)
+            if photos:
+                add_photos(page, rng, photos, photo_coverage)
+            if drawings:
+                add_drawings(page, rng, drawings)
+            if text_density:
+                add_text(page, rng, text_density)
+            if form_fields:
+                add_form_fields(page, rng, form_fields, number)
+            if annotations:
+                add_annotations(page, rng, annotations)
+        doc.save(path, garbage=1, deflate=True, no_new_id=True)
+    finally:
+        doc.close()
+
+
+def generate_corpus(name, directory, seed=SEED):
+    """Write the documents of corpus `name` to `directory` and return their paths."""
+    try:
+        documents = CORPORA[name]
+    except KeyError:
+        raise ValueError(f"Unknown corpus: {name}. Choose one of: {', '.join(CORPORA)}") from None
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for file_name, options in documents.items():
+        path = os.path.join(directory, file_name)
+        generate_document(path, seed=seed, **options)
+        paths.append(path)
+    return paths
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pdf_flattener.benchmarks.corpus",
+        description="Generate a deterministic corpus of synthetic PDFs.",
+    )
+    parser.add_argument("corpus", choices=list(CORPORA), help="Corpus to generate")
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Directory for the generated files (default: current directory)",
+        default=".",
+    )
+    parser.add_argument(
+        "--seed", type=int, help=f"Random seed (default: {SEED})", default=SEED
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    for path in generate_corpus(args.corpus, args.output, args.seed):
+        print(path, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
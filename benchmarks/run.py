@@ -0,0 +1,304 @@
+"""Time each stage of the pipeline on a set of generated documents.
+
+Every measurement runs in a fresh process, so its peak RSS belongs to that
+stage alone (plus the interpreter and the stage's inputs). Results are
+written as JSON; a summary table goes to stderr.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from .. import __version__
+from .. import cli
+from ..stats import children_cpu_seconds, peak_rss_bytes
+from .corpus import SEED, generate_document
+
+REPEAT = 3
+STAGES = (
+    "extract_images_from_pdf",
+    "create_pdf_from_images",
+    "compress_pdf",
+    "set_metadata",
+    "flatten_pdf",
+    "bake_pdf",
+)
+
+
+# Document profile name -> corpus.generate_document arguments
+PROFILES = {
+    "text": {"pages": 20, "text_density": 1.0},
+    "vector": {"pages": 10, "text_density": 0.2, "drawings": 400},
+    "image": {"pages": 5, "text_density": 0, "photos": 1, "photo_coverage": 1.0},
+    "poster": {"pages": 2, "page_size": "poster", "text_density": 0.2, "drawings": 1000},
+    "forms": {"pages": 4, "text_density": 0.5, "form_fields": 8, "annotations": 6},
+}
+
+
+def reset_peak_rss():
+    """Make the peak RSS start from the current RSS, where the OS supports it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def prepare_inputs(pdf_path, backend, dpi, workdir):
+    """Write the intermediate files later stages start from.
+
+    Returns the paths of the assembled but uncompressed PDF and of the final
+    flattened PDF.
+    """
+    uncompressed_path = os.path.join(workdir, f"uncompressed-{backend}.pdf")
+    flattened_path = os.path.join(workdir, f"flattened-{backend}.pdf")
+    cli.create_pdf_from_images(
+        cli.iter_images_from_pdf(pdf_path, dpi, backend), uncompressed_path
+    )
+    cli.compress_pdf(uncompressed_path, flattened_path)
+    return uncompressed_path, flattened_path
+
+
+def measure(stage, pdf_path, backend, dpi, workdir, inputs):
+    """Run one stage once in the current process and return its measurements.
+
+    Rendered images needed by a stage are prepared before the clock starts.
+    """
+    uncompressed_path, flattened_path = inputs
+    output_path = os.path.join(workdir, f"{stage}.pdf")
+    if stage == "extract_images_from_pdf":
+        def run():
+            cli.extract_images_from_pdf(pdf_path, dpi, backend)
+    elif stage == "create_pdf_from_images":
+        images = cli.extract_images_from_pdf(pdf_path, dpi, backend)
+
+        def run():
+            cli.create_pdf_from_images(images, output_path)
+    elif stage == "compress_pdf":
+        def run():
+            cli.compress_pdf(uncompressed_path, output_path)
+    elif stage == "set_metadata":
+        shutil.copyfile(flattened_path, output_path)
+
+        def run():
+            cli.set_metadata(output_path, "2020-01-01", "2020-01-02")
+    elif stage == "flatten_pdf":
+        def run():
+            cli.flatten_pdf(pdf_path, output_path, dpi=dpi, backend=backend)
+    elif stage == "bake_pdf":
+        def run():
+            cli.flatten_pdf(pdf_path, output_path, mode="bake")
+    else:
+        raise ValueError(f"Unknown stage: {stage}. Choose one of: {', '.join(STAGES)}")
+
+    reset_peak_rss()
+    children_cpu = children_cpu_seconds()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    run()
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    if children_cpu is not None:
+        children_cpu = children_cpu_seconds() - children_cpu
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "children_cpu_seconds": children_cpu,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "output_bytes": os.path.getsize(output_path) if os.path.exists(output_path) else None,
+    }
+
+
+def benchmark_stage(stage, pdf_path, pages, backend, dpi, repeat, workdir, inputs):
+    """Measure a stage `repeat` times, each time in a new process."""
+    runs = []
+    context = get_context("spawn")
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            future = executor.submit(measure, stage, pdf_path, backend, dpi, workdir, inputs)
+            runs.append(future.result())
+    median = statistics.median(run["wall_seconds"] for run in runs)
+    output_bytes = runs[-1]["output_bytes"]
+    rss = [run["peak_rss_bytes"] for run in runs if run["peak_rss_bytes"] is not None]
+    return {
+        "stage": stage,
+        "pages": pages,
+        "wall_seconds": [run["wall_seconds"] for run in runs],
+        "cpu_seconds": [run["cpu_seconds"] for run in runs],
+        "children_cpu_seconds": [run["children_cpu_seconds"] for run in runs],
+        "median_seconds": median,
+        "pages_per_second": pages / median if median else None,
+        "peak_rss_bytes": max(rss) if rss else None,
+        "output_bytes": output_bytes,
+        "bytes_per_page": output_bytes / pages if output_bytes is not None else None,
+    }
+
+
+def environment():
+    import fitz
+    import PIL
+
+    try:
+        from importlib.metadata import version
+
+        pdf2image_version = version("pdf2image")
+    except Exception:
+        pdf2image_version = None
+    return {
+        "pdf_flattener": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pymupdf": fitz.VersionBind,
+        "mupdf": fitz.VersionFitz,
+        "pdf2image": pdf2image_version,
+        "pillow": PIL.__version__,
+    }
+
+
+def run_benchmarks(
+    profiles=tuple(PROFILES),
+    stages=STAGES,
+    backends=("mupdf",),
+    dpi=cli.DPI,
+    repeat=REPEAT,
+    pages=None,
+    seed=SEED,
+    log=None,
+):
+    """Benchmark every stage on every profile and backend.
+
+    `pages` overrides the page count of every profile, and `seed` seeds the
+    generated documents. Returns a dictionary with the environment and one
+    result per profile, backend and stage.
+    """
+    if repeat < 1:
+        raise ValueError("repeat must be at least 1")
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}. Choose one of: {', '.join(STAGES)}")
+    for backend in backends:
+        cli.get_renderer(backend)
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="pdf-flattener-bench-")
+    try:
+        for profile in profiles:
+            try:
+                options = dict(PROFILES[profile])
+            except KeyError:
+                raise ValueError(
+                    f"Unknown profile: {profile}. Choose one of: {', '.join(PROFILES)}"
+                ) from None
+            if pages:
+                options["pages"] = pages
+            profile_pages = options["pages"]
+            pdf_path = os.path.join(workdir, f"{profile}.pdf")
+            generate_document(pdf_path, seed=seed, **options)
+            for backend in backends:
+                inputs = prepare_inputs(pdf_path, backend, dpi, workdir)
+                for stage in stages:
+                    result = benchmark_stage(
+                        stage, pdf_path, profile_pages, backend, dpi, repeat, workdir, inputs
+                    )
+                    result.update(
+                        profile=profile,
+                        backend=backend,
+                        dpi=dpi,
+                        input_bytes=os.path.getsize(pdf_path),
+                    )
+                    results.append(result)
+                    if log:
+                        log(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"environment": environment(), "results": results}
+
+
+def format_result(result):
+    rss = result["peak_rss_bytes"]
+    per_page = result["bytes_per_page"]
+    return (
+        f"{result['profile']:<8} {result['backend']:<8} {result['stage']:<24} "
+        f"{result['median_seconds']:8.3f} s {result['pages_per_second']:8.2f} pages/s "
+        f"{rss / 1024 / 1024 if rss else float('nan'):8.1f} MB "
+        f"{per_page / 1024 if per_page is not None else float('nan'):8.1f} KB/page"
+    )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pdf_flattener.benchmarks",
+        description="Benchmark each stage of PDF flattening on generated documents.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        choices=sorted(PROFILES),
+        help="Document profile to benchmark, may be repeated (default: all)",
+    )
+    parser.add_argument(
+        "--stage",
+        action="append",
+        choices=STAGES,
+        help="Pipeline stage to benchmark, may be repeated (default: all)",
+    )
+    parser.add_argument(
+        "--backend",
+        "-b",
+        action="append",
+        choices=sorted(cli.RENDERERS),
+        help="Rendering backend, may be repeated (default: mupdf)",
+    )
+    parser.add_argument(
+        "--dpi",
+        "-d",
+        type=int,
+        help=f"DPI for image extraction (default: {cli.DPI})",
+        default=cli.DPI,
+    )
+    parser.add_argument(
+        "--repeat",
+        "-r",
+        type=int,
+        help=f"Runs per measurement; the median is reported (default: {REPEAT})",
+        default=REPEAT,
+    )
+    parser.add_argument(
+        "--pages", type=int, help="Override the page count of every profile", default=None
+    )
+    parser.add_argument(
+        "--seed", type=int, help=f"Seed for the generated documents (default: {SEED})", default=SEED
+    )
+    parser.add_argument(
+        "--output", "-o", help="Write the JSON results to this file instead of stdout"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    report = run_benchmarks(
+        profiles=args.profile or tuple(PROFILES),
+        stages=args.stage or STAGES,
+        backends=args.backend or ("mupdf",),
+        dpi=args.dpi,
+        repeat=args.repeat,
+        pages=args.pages,
+        seed=args.seed,
+        log=lambda result: print(format_result(result), file=sys.stderr),
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,371 @@
+"""Content-addressed on-disk caches of flattened documents and rendered pages,
+and checkpoints of documents being flattened."""
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from . import __version__
+from .cli import get_page_count, is_pdf_data, logger, open_pdf
+
+CACHE_MAX_MB = 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Indirect references inside a PDF object's source, e.g. "12 0 R"
+REFERENCE = re.compile(rb"(\d+) \d+ R\b")
+# Back-references to the page tree or owning page; hashing them would make a
+# page's key depend on every other page of its document.
+BACK_REFERENCE = re.compile(rb"/(Parent|P) \d+ \d+ R\b")
+
+
+def hash_file(path):
+    """Hash a file's contents; the bytes of a PDF may be passed instead of a path."""
+    if is_pdf_data(path):
+        return hashlib.sha256(path).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def page_fingerprints(pdf_path):
+    """Return a content hash for every page of `pdf_path`.
+
+    A page's hash covers its dictionary, content streams, resources and
+    annotations, with object numbers replaced by the hashes of the objects
+    they point to. Identical pages therefore get the same hash even when
+    they sit in different documents.
+    """
+    doc = open_pdf(pdf_path)
+    try:
+        digests = {}
+
+        def digest(xref):
+            if xref in digests:
+                return digests[xref]
+            digests[xref] = b"cycle"
+            source = BACK_REFERENCE.sub(b"", doc.xref_object(xref, compressed=True).encode())
+            source = REFERENCE.sub(lambda m: digest(int(m.group(1))), source)
+            h = hashlib.sha256(source)
+            if doc.xref_is_stream(xref):
+                h.update(doc.xref_stream_raw(xref))
+            digests[xref] = h.hexdigest().encode()
+            return digests[xref]
+
+        fingerprints = []
+        for page in doc:
+            h = hashlib.sha256(digest(page.xref))
+            # Inherited attributes live on the page tree, which is not hashed
+            h.update(f"{tuple(page.mediabox)}{tuple(page.cropbox)}{page.rotation}".encode())
+            resources = doc.xref_get_key(page.xref, "Resources")
+            if resources[0] == "null":
+                parent = doc.xref_get_key(page.xref, "Parent")
+                while resources[0] == "null" and parent[0] == "xref":
+                    parent_xref = int(parent[1].split()[0])
+                    resources = doc.xref_get_key(parent_xref, "Resources")
+                    parent = doc.xref_get_key(parent_xref, "Parent")
+                if resources[0] == "xref":
+                    h.update(digest(int(resources[1].split()[0])))
+                else:
+                    h.update(REFERENCE.sub(
+                        lambda m: digest(int(m.group(1))), resources[1].encode()
+                    ))
+            fingerprints.append(h.hexdigest())
+        return fingerprints
+    finally:
+        doc.close()
+
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_atomic(path, data):
+    """Write `data` to `path` so that readers see either nothing or all of it."""
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write_bytes(temp_path, data)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class CacheMiss(LookupError):
+    """Raised when a cache entry does not exist."""
+
+
+class DiskCache:
+    """Files below `directory`, evicted least recently used first.
+
+    Reading an entry refreshes its modification time, and once the cache
+    grows past `max_bytes` the oldest entries are removed.
+    """
+
+    suffix = ""
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}{self.suffix}")
+
+    def write(self, key, write_to):
+        """Atomically create the entry for `key` by calling `write_to(path)`."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            write_to(temp_path)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """Return `(mtime, size, path)` for every entry, oldest first."""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits `max_bytes`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to evict cache entry {path}: {e}")
+                continue
+            total -= size
+        self.size = total
+
+
+class ResultCache(DiskCache):
+    """Flattened PDFs keyed on the input bytes and every output-affecting option."""
+
+    suffix = ".pdf"
+
+    def key(self, pdf_path, **options):
+        """Return the cache key for flattening `pdf_path` with `options`."""
+        params = json.dumps(
+            {"input": hash_file(pdf_path), "version": __version__, **options},
+            sort_keys=True,
+        )
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def fetch(self, key, destination):
+        """Copy the entry for `key` to `destination`, raising CacheMiss if absent."""
+        path = self.path(key)
+        try:
+            shutil.copyfile(path, destination)
+            os.utime(path)
+        except FileNotFoundError:
+            # Never cached, or evicted by another process in the meantime
+            raise CacheMiss(key) from None
+
+    def read(self, key):
+        """Return the entry for `key` as bytes, raising CacheMiss if absent."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            raise CacheMiss(key) from None
+        return data
+
+    def store(self, key, source_path):
+        """Add `source_path` to the cache under `key` and evict old entries."""
+        self.write(key, lambda path: shutil.copyfile(source_path, path))
+
+    def store_bytes(self, key, data):
+        """Add `data` to the cache under `key` and evict old entries."""
+        self.write(key, lambda path: write_bytes(path, data))
+
+
+class PageCache(DiskCache):
+    """Encoded page images keyed on page content, shared across documents.
+
+    `hits` and `misses` count lookups made through this instance.
+    """
+
+    suffix = ".page"
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        super().__init__(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self, pdf_path, **options):
+        """Return the cache key of every page of `pdf_path` rendered with `options`."""
+        return [
+            hashlib.sha256(
+                json.dumps(
+                    {"page": fingerprint, "version": __version__, **options},
+                    sort_keys=True,
+                ).encode()
+            ).hexdigest()
+            for fingerprint in page_fingerprints(pdf_path)
+        ]
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Return the encoded page for `key`, or None on a miss."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.write(key, lambda path: write_bytes(path, data))
+
+
+class Checkpoint:
+    """Encoded pages of one document kept in `directory` while it is flattened.
+
+    Every page is written as soon as it is rendered, next to a manifest
+    recording the input hash and options. If flattening is interrupted, a
+    run with the same input and options finds the pages already done and
+    renders only the rest. Pages of a different input or options are
+    discarded. Used in place of a page cache by `flatten_pdf`; a real
+    `page_cache`, if given, is still consulted for pages not checkpointed.
+    """
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, directory, page_cache=None):
+        self.directory = directory
+        self.page_cache = page_cache
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, number):
+        return os.path.join(self.directory, f"page-{number:06d}.page")
+
+    def manifest(self, pdf_path, options):
+        manifest = {
+            "input": hash_file(pdf_path),
+            "version": __version__,
+            "options": options,
+            "page_count": get_page_count(pdf_path),
+        }
+        # Compare as it reads back from JSON, where tuples become lists
+        return json.loads(json.dumps(manifest))
+
+    def keys(self, pdf_path, **options):
+        """Start or resume checkpointing `pdf_path` and return a key per page.
+
+        A manifest that doesn't match the input and options is replaced and
+        its pages removed.
+        """
+        manifest = self.manifest(pdf_path, options)
+        manifest_path = os.path.join(self.directory, self.manifest_name)
+        try:
+            with open(manifest_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = None
+        if previous != manifest:
+            if previous is not None:
+                logger.warning(
+                    f"Discarding the checkpoint in {self.directory}: it was made "
+                    f"for a different input or different options"
+                )
+            self.clear()
+            write_atomic(manifest_path, json.dumps(manifest, sort_keys=True).encode())
+        done = sum(
+            os.path.exists(self.path(number))
+            for number in range(1, manifest["page_count"] + 1)
+        )
+        if done:
+            logger.info(
+                f"Resuming from {self.directory}: {done} of {manifest['page_count']} "
+                f"pages already done"
+            )
+
+        if self.page_cache is not None:
+            cache_keys = self.page_cache.keys(pdf_path, **options)
+        else:
+            cache_keys = [None] * manifest["page_count"]
+        return list(enumerate(cache_keys, start=1))
+
+    def __contains__(self, key):
+        number, cache_key = key
+        return os.path.exists(self.path(number)) or (
+            self.page_cache is not None and cache_key in self.page_cache
+        )
+
+    def get(self, key):
+        """Return the encoded page for `key`, or None if it still has to be rendered."""
+        number, cache_key = key
+        try:
+            with open(self.path(number), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+            if self.page_cache is not None:
+                data = self.page_cache.get(cache_key)
+                if data is not None:
+                    write_atomic(self.path(number), data)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        number, cache_key = key
+        write_atomic(self.path(number), data)
+        if self.page_cache is not None:
+            self.page_cache.put(cache_key, data)
+
+    def clear(self):
+        """Remove the manifest and every checkpointed page."""
+        paths = glob.glob(os.path.join(glob.escape(self.directory), "page-*.page"))
+        paths.append(os.path.join(self.directory, self.manifest_name))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
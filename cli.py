@@ -1,21 +1,90 @@
 import platform
 import sys
 import os
+import io
+import math
 import shutil
 import tempfile
-import fitz
-from pdf2image import convert_from_path
 from datetime import datetime
-import subprocess
+from collections import deque
 from contextlib import contextmanager
+import glob
+import json
 import logging
 import time
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Heavy dependencies (fitz, pdf2image, PIL, multiprocessing) are imported on
+# first use so that importing the package stays cheap. Logging is configured by
+# main() only, never at import time.
 logger = logging.getLogger(__name__)
 
 DPI = 200
+# Number of pages Poppler decodes per call; bounds peak memory while streaming.
+RENDER_BATCH_SIZE = 4
+BACKEND = "poppler"
+JPEG_QUALITY = 50
+# Quality range searched when a page must fit a byte budget, and the most
+# trial encodes spent on one page (enough to bisect the whole range)
+MIN_JPEG_QUALITY = 5
+MAX_JPEG_QUALITY = 95
+QUALITY_SEARCH_STEPS = 7
+# Qualities every page is encoded at when an output size limit is shared
+# out between pages, see allocate_qualities
+QUALITY_LEVELS = (5, 10, 20, 30, 40, 50, 65, 80, 95)
+# Bytes of page, image and content objects added to each encoded page, and
+# of the rest of the document, reserved from an output size limit
+PAGE_OVERHEAD_BYTES = 512
+DOCUMENT_OVERHEAD_BYTES = 1024
+# Assemblies tried before giving up on an output size limit; each one
+# shrinks the budget by the previous overshoot
+SIZE_LIMIT_ATTEMPTS = 3
+# Marks encoded pages holding several quality variants, see pack_ladder
+LADDER_MAGIC = b"FLATLADDER\n"
+JOBS = 1
+WORKERS = 1
+# Pages handed to a worker process per task when rendering with jobs > 1
+PAGES_PER_JOB = 8
+# Largest raster rendered for one page; bigger pages get a lower DPI
+MAX_PIXELS = 100_000_000
+# Bytes per pixel of a rendered RGB page
+BYTES_PER_PIXEL = 3
+# Bilevel mode: "off", "auto" (detect text-only pages) or "force"
+BILEVEL = "off"
+BILEVEL_MODES = ("off", "auto", "force")
+# Gray level splitting black from white when thresholding a page
+BILEVEL_THRESHOLD = 128
+# Share of the inked pixels that may be mid-gray (anti-aliased edges) on a
+# bilevel page, and share of all pixels that may be in saturated color
+BILEVEL_TOLERANCE = 0.6
+# Share of the non-white pixels that may be light gray, which thresholding
+# turns white: the faint outer fringe of text, but not light fills or watermarks
+BILEVEL_LIGHT_TOLERANCE = 0.5
+# Gray levels at and above this count as paper white
+BILEVEL_WHITE = 251
+BILEVEL_COLOR_TOLERANCE = 0.01
+# Grayscale mode: "off", "auto" (detect pages without color) or "force"
+# (render every page in DeviceGray)
+GRAYSCALE = "off"
+GRAYSCALE_MODES = ("off", "auto", "force")
+# Chroma (max - min of R, G, B) above which a pixel counts as colored, and the
+# share of colored pixels a page may have and still be stored as gray
+GRAYSCALE_CHROMA = 24
+GRAYSCALE_TOLERANCE = 0.001
+# Pages with more pixels than this are rendered and stored as horizontal bands
+# of at most this many pixels each (None: always render whole pages)
+BAND_PIXELS = None
+# Band heights are a multiple of the JPEG MCU height so seams stay invisible
+BAND_ALIGN = 16
+# Marks encoded pages made of several bands, see pack_bands
+BANDS_MAGIC = b"FLATBANDS\n"
+# "rasterize" renders pages to images; "bake" only burns form fields and
+# annotations into the page content, keeping text and vectors
+MODE = "rasterize"
+MODES = ("rasterize", "bake")
+# Pages to rasterize: "all", or "auto" (pages with form fields, annotations
+# or optional content); all other pages are copied unchanged
+SELECT = "all"
+SELECT_MODES = ("all", "auto")
 
 @contextmanager
 def safe_temp_file(suffix):
@@ -132,74 +201,1041 @@ def get_poppler_path():
         )
         return None
 
-def extract_images_from_pdf(pdf_path, dpi=DPI):
-    if not os.path.exists(pdf_path):
-        raise FileNotFoundError(f"Input PDF file not found: {pdf_path}")
-    
+def is_pdf_data(source):
+    """Return True if `source` holds the bytes of a PDF rather than its path."""
+    return isinstance(source, (bytes, bytearray))
+
+def open_pdf(source):
+    """Open a PDF given its path or its bytes."""
+    import fitz
+
+    if is_pdf_data(source):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+def check_input(source):
+    if not is_pdf_data(source) and not os.path.exists(source):
+        raise FileNotFoundError(f"Input PDF file not found: {source}")
+
+@contextmanager
+def write_temp_pdf(data):
+    """Context manager yielding the path of a temporary file holding `data`."""
+    with safe_temp_file(suffix=".pdf") as temp_path:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        yield temp_path
+
+def get_page_count(pdf_path):
+    doc = open_pdf(pdf_path)
     try:
-        poppler_path = get_poppler_path()
-        images = convert_from_path(pdf_path, dpi=dpi, poppler_path=poppler_path)
-        return images
-    except Exception as e:
-        logger.error(f"Failed to extract images from PDF: {e}")
+        return doc.page_count
+    finally:
+        doc.close()
+
+def parse_page_range(text, page_count):
+    """Return the 1-based page numbers of a range like "1-3,7,10-" as a set.
+
+    Open-ended ranges run to the last page; numbers past it are ignored.
+    """
+    numbers = set()
+    for part in text.split(","):
+        first, dash, last = part.strip().partition("-")
+        try:
+            first = int(first)
+            last = (int(last) if last else page_count) if dash else first
+        except ValueError:
+            raise ValueError(f"Invalid page range: {text}") from None
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid page range: {text}")
+        numbers.update(range(first, min(last, page_count) + 1))
+    return numbers
+
+def needs_flattening(page):
+    """Return True if a page has form fields, annotations or optional content."""
+    doc = page.parent
+    if page.first_widget or page.first_annot:
+        return True
+    # Optional content is referenced through marked-content properties or
+    # the /OC entry of images and form XObjects
+    if doc.xref_get_key(page.xref, "Resources/Properties")[0] != "null":
+        return True
+    xrefs = [image[0] for image in page.get_images(full=True)]
+    xrefs += [xobject[0] for xobject in page.get_xobjects()]
+    return any(doc.xref_get_key(xref, "OC")[0] != "null" for xref in xrefs if xref)
+
+def select_pages(pdf_path, select=SELECT, pages=None):
+    """Return the numbers of the pages to rasterize, or None for every page.
+
+    `pages` is a page range string (see `parse_page_range`) or an iterable
+    of 1-based page numbers. With `select="auto"`, pages that need
+    flattening (see `needs_flattening`) are added to it.
+    """
+    if select not in SELECT_MODES:
+        raise ValueError(f"select must be one of: {', '.join(SELECT_MODES)}")
+    if select == "all" and pages is None:
+        return None
+    doc = open_pdf(pdf_path)
+    try:
+        if pages is None:
+            numbers = set()
+        elif isinstance(pages, str):
+            numbers = parse_page_range(pages, doc.page_count)
+        else:
+            numbers = {number for number in pages if 1 <= number <= doc.page_count}
+        if select == "auto":
+            numbers.update(page.number + 1 for page in doc if needs_flattening(page))
+        return numbers
+    finally:
+        doc.close()
+
+def get_pixel_budget(max_pixels=MAX_PIXELS, max_memory_mb=None):
+    """Combine a pixel limit and a memory limit into one per-page pixel budget."""
+    limits = [limit for limit in (max_pixels,) if limit]
+    if max_memory_mb:
+        limits.append(int(max_memory_mb * 1024 * 1024 / BYTES_PER_PIXEL))
+    return min(limits) if limits else None
+
+def effective_dpi(width, height, dpi, max_pixels=MAX_PIXELS):
+    """Return the highest DPI up to `dpi` at which a `width` x `height` pt page fits `max_pixels`."""
+    def pixels(resolution):
+        return math.ceil(width * resolution / 72) * math.ceil(height * resolution / 72)
+
+    if not max_pixels or pixels(dpi) <= max_pixels:
+        return dpi
+    resolution = max(1, int(dpi * math.sqrt(max_pixels / pixels(dpi))))
+    while resolution > 1 and pixels(resolution) > max_pixels:
+        resolution -= 1
+    return resolution
+
+def plan_page_dpis(pdf_path, dpi, max_pixels=MAX_PIXELS, first_page=1, last_page=None):
+    """Return the DPI to render each page from `first_page` to `last_page` at.
+
+    Pages whose raster at `dpi` would exceed `max_pixels` get a lower DPI and
+    a warning, so the memory needed for one page is known in advance.
+    """
+    doc = open_pdf(pdf_path)
+    try:
+        if last_page is None:
+            last_page = doc.page_count
+        dpis = []
+        for number in range(first_page, last_page + 1):
+            rect = doc[number - 1].rect
+            page_dpi = effective_dpi(rect.width, rect.height, dpi, max_pixels)
+            if page_dpi < dpi:
+                logger.warning(
+                    f"Page {number} ({rect.width:.0f}x{rect.height:.0f} pt) exceeds the "
+                    f"pixel budget of {max_pixels} at {dpi} DPI; rendering at {page_dpi} DPI"
+                )
+            dpis.append(page_dpi)
+        return dpis
+    finally:
+        doc.close()
+
+def get_page_sizes(pdf_path):
+    """Return the `(width, height)` in points of every page, as it is rendered."""
+    doc = open_pdf(pdf_path)
+    try:
+        return [(page.rect.width, page.rect.height) for page in doc]
+    finally:
+        doc.close()
+
+def plan_batches(first_page, dpis, batch_size):
+    """Split pages into runs of up to `batch_size` consecutive pages sharing one DPI.
+
+    `dpis` holds the resolution of each page starting at `first_page`.
+    Returns `(first_page, last_page, dpi)` tuples for pdftoppm calls.
+    """
+    batches = []
+    for number, dpi in enumerate(dpis, start=first_page):
+        if batches and batches[-1][2] == dpi and number - batches[-1][0] < batch_size:
+            batches[-1][1] = number
+        else:
+            batches.append([number, number, dpi])
+    return [tuple(batch) for batch in batches]
+
+def render_pages_poppler(
+    pdf_path, first_page, dpis, batch_size, gray=False, band_pixels=None
+):
+    """Render pages by running Poppler's pdftoppm through pdf2image.
+
+    `dpis` holds the resolution of each page starting at `first_page`. With
+    `gray`, pages are rendered as single-channel images. pdf2image cannot
+    crop, so `band_pixels` is ignored and pages are always rendered whole.
+    """
+    from pdf2image import convert_from_path
+
+    if is_pdf_data(pdf_path):
+        # pdftoppm only reads files; write the document out once for all batches
+        with write_temp_pdf(pdf_path) as temp_path:
+            yield from render_pages_poppler(
+                temp_path, first_page, dpis, batch_size, gray, band_pixels
+            )
+        return
+
+    poppler_path = get_poppler_path()
+    for batch_first, batch_last, dpi in plan_batches(first_page, dpis, batch_size):
+        images = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            poppler_path=poppler_path,
+            first_page=batch_first,
+            last_page=batch_last,
+            grayscale=gray,
+        )
+        # Hand pages over one by one so the batch list doesn't keep them alive
+        while images:
+            yield images.pop(0)
+
+class BandedPage:
+    """A page rendered lazily as horizontal bands, top to bottom.
+
+    Iterating renders one band at a time; the bands must be consumed before
+    the renderer moves on to the next page.
+    """
+
+    def __init__(self, size, bands):
+        self.size = size
+        self.bands = bands
+        self.info = {}
+
+    def __iter__(self):
+        return iter(self.bands)
+
+def plan_bands(width, height, band_pixels):
+    """Split `height` rows of `width` pixels into `(top, bottom)` bands."""
+    rows = max(BAND_ALIGN, band_pixels // width // BAND_ALIGN * BAND_ALIGN)
+    return [(top, min(top + rows, height)) for top in range(0, height, rows)]
+
+def render_pages_mupdf(
+    pdf_path, first_page, dpis, batch_size, gray=False, band_pixels=None
+):
+    """Render pages in-process with MuPDF; no subprocess or temp files.
+
+    Pages with more than `band_pixels` pixels are yielded as `BandedPage`s
+    whose bands are rendered through clip rectangles, so only one band is
+    held in memory at a time.
+    """
+    import fitz
+    from PIL import Image
+
+    colorspace, mode = (fitz.csGRAY, "L") if gray else (fitz.csRGB, "RGB")
+
+    def render(page, matrix, clip=None):
+        pix = page.get_pixmap(matrix=matrix, colorspace=colorspace, clip=clip)
+        return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+    def render_bands(page, matrix, area, bands):
+        inverse = ~matrix
+        for top, bottom in bands:
+            # Clip on whole device pixels so the bands tile the page exactly
+            clip = fitz.Rect(area.x0, area.y0 + top, area.x1, area.y0 + bottom) * inverse
+            yield render(page, matrix, clip)
+
+    doc = open_pdf(pdf_path)
+    try:
+        for page, dpi in zip(doc.pages(first_page - 1, first_page - 1 + len(dpis)), dpis):
+            matrix = fitz.Matrix(dpi / 72, dpi / 72)
+            area = (page.rect * matrix).irect
+            if band_pixels and area.width * area.height > band_pixels:
+                bands = plan_bands(area.width, area.height, band_pixels)
+                yield BandedPage(
+                    (area.width, area.height), render_bands(page, matrix, area, bands)
+                )
+            else:
+                yield render(page, matrix)
+    finally:
+        doc.close()
+
+RENDERERS = {
+    "poppler": render_pages_poppler,
+    "mupdf": render_pages_mupdf,
+}
+
+def get_renderer(backend):
+    try:
+        return RENDERERS[backend]
+    except KeyError:
+        raise ValueError(
+            f"Unknown rendering backend: {backend}. "
+            f"Choose one of: {', '.join(sorted(RENDERERS))}"
+        ) from None
+
+def iter_images_from_pdf(
+    pdf_path,
+    dpi=DPI,
+    backend=BACKEND,
+    batch_size=RENDER_BATCH_SIZE,
+    first_page=1,
+    last_page=None,
+    max_pixels=MAX_PIXELS,
+    gray=False,
+    band_pixels=BAND_PIXELS,
+):
+    """Yield the rendered pages of a PDF one at a time.
+
+    At most `batch_size` pages are decoded at once, so memory use stays flat
+    regardless of the number of pages in the document. `first_page` and
+    `last_page` are 1-based and inclusive. Pages larger than `max_pixels` at
+    `dpi` are rendered at a lower DPI, which is recorded in each image's
+    `info["dpi"]`. With `gray`, pages are rendered directly in DeviceGray.
+    With the MuPDF backend, pages larger than `band_pixels` are yielded as
+    `BandedPage`s.
+    """
+    check_input(pdf_path)
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    renderer = get_renderer(backend)
+
+    def generate():
+        try:
+            dpis = plan_page_dpis(pdf_path, dpi, max_pixels, first_page, last_page)
+            images = renderer(pdf_path, first_page, dpis, batch_size, gray, band_pixels)
+            for image, page_dpi in zip(images, dpis):
+                image.info["dpi"] = (page_dpi, page_dpi)
+                yield image
+        except Exception as e:
+            logger.error(f"Failed to extract images from PDF: {e}")
+            raise
+
+    return generate()
+
+def extract_images_from_pdf(pdf_path, dpi=DPI, backend=BACKEND, max_pixels=MAX_PIXELS):
+    return list(iter_images_from_pdf(pdf_path, dpi, backend, max_pixels=max_pixels))
+
+def chroma_histogram(image):
+    """Histogram of per-pixel chroma, max(R, G, B) - min(R, G, B), of an RGB image.
+
+    Computed with Pillow's C channel operations, without a Python-level loop
+    over the pixels.
+    """
+    from PIL import ImageChops
+
+    red, green, blue = image.split()
+    brightest = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    darkest = ImageChops.darker(ImageChops.darker(red, green), blue)
+    return ImageChops.subtract(brightest, darkest).histogram()
+
+def is_grayscale(image, tolerance=GRAYSCALE_TOLERANCE):
+    """Return True if at most `tolerance` of a page's pixels carry visible color."""
+    if image.mode in ("1", "L"):
+        return True
+    colored = sum(chroma_histogram(image.convert("RGB"))[GRAYSCALE_CHROMA + 1:])
+    return colored <= tolerance * image.width * image.height
+
+def is_bilevel(image, tolerance=BILEVEL_TOLERANCE):
+    """Return True if a page is effectively black on white.
+
+    Text has a thin gray fringe of anti-aliased edges around dark strokes,
+    whereas gray fills and photos are mostly mid-gray, and light fills and
+    watermarks are mostly light gray that thresholding would erase. A page
+    is bilevel when at most `tolerance` of its inked pixels are mid-gray, at
+    most `BILEVEL_LIGHT_TOLERANCE` of its non-white pixels are light gray,
+    and next to none of its pixels are in saturated color.
+    """
+    gray = image.convert("L").histogram()
+    dark = sum(gray[:64])
+    mid = sum(gray[64:192])
+    light = sum(gray[192:BILEVEL_WHITE])
+    if mid > tolerance * (dark + mid):
+        return False
+    if light > BILEVEL_LIGHT_TOLERANCE * (dark + mid + light):
+        return False
+    if image.mode == "RGB":
+        colored = sum(chroma_histogram(image)[64:])
+        if colored > BILEVEL_COLOR_TOLERANCE * image.width * image.height:
+            return False
+    return True
+
+def encode_bilevel(image):
+    """Threshold a page to 1 bit per pixel and encode it as CCITT Group 4 TIFF."""
+    from PIL import Image
+
+    bitonal = image.convert("L").point(
+        lambda value: 255 if value >= BILEVEL_THRESHOLD else 0
+    ).convert("1", dither=Image.Dither.NONE)
+    buffer = io.BytesIO()
+    # A single strip lets the G4 data be copied into the PDF as-is
+    bitonal.save(
+        buffer, format="TIFF", compression="group4", tiffinfo={278: bitonal.height}
+    )
+    return buffer.getvalue()
+
+def check_modes(bilevel=BILEVEL, grayscale=GRAYSCALE):
+    if bilevel not in BILEVEL_MODES:
+        raise ValueError(f"bilevel must be one of: {', '.join(BILEVEL_MODES)}")
+    if grayscale not in GRAYSCALE_MODES:
+        raise ValueError(f"grayscale must be one of: {', '.join(GRAYSCALE_MODES)}")
+
+def encode_jpeg(image, quality=JPEG_QUALITY):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+def encode_jpeg_to_size(image, target_bytes, steps=QUALITY_SEARCH_STEPS):
+    """Return `(data, quality)` for the highest JPEG quality that fits `target_bytes`.
+
+    Bisects MIN_JPEG_QUALITY to MAX_JPEG_QUALITY in at most `steps` trial
+    encodes of the same raster. Pages that don't fit even at the lowest
+    quality get MIN_JPEG_QUALITY.
+    """
+    low, high = MIN_JPEG_QUALITY, MAX_JPEG_QUALITY
+    best = None
+    for _ in range(steps):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        data = encode_jpeg(image, quality)
+        if len(data) <= target_bytes:
+            best = data, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = encode_jpeg(image, MIN_JPEG_QUALITY), MIN_JPEG_QUALITY
+    return best
+
+def encode_image_with_quality(
+    image, quality=JPEG_QUALITY, bilevel=BILEVEL, grayscale=GRAYSCALE, target_bytes=None
+):
+    """Encode a page like `encode_image` and return `(data, quality)`.
+
+    The quality is the JPEG quality used, or None for bilevel pages.
+    """
+    check_modes(bilevel, grayscale)
+    if bilevel == "force" or (bilevel == "auto" and is_bilevel(image)):
+        return encode_bilevel(image), None
+    if image.mode != "L" and (
+        grayscale == "force" or (grayscale == "auto" and is_grayscale(image))
+    ):
+        image = image.convert("L")
+    if target_bytes:
+        return encode_jpeg_to_size(image, target_bytes)
+    return encode_jpeg(image, quality), quality
+
+def encode_image(
+    image, quality=JPEG_QUALITY, bilevel=BILEVEL, grayscale=GRAYSCALE, target_bytes=None
+):
+    """Encode a rendered page as JPEG bytes, or as G4 TIFF for bilevel pages.
+
+    Pages without color (always with grayscale="force") are stored as
+    single-channel gray JPEGs. With `target_bytes`, the JPEG quality is the
+    highest that keeps the page within that many bytes (see
+    `encode_jpeg_to_size`) instead of `quality`.
+    """
+    return encode_image_with_quality(image, quality, bilevel, grayscale, target_bytes)[0]
+
+def pack_bands(bands):
+    """Combine the encoded bands of a page into a single encoded page."""
+    return BANDS_MAGIC + b"".join(
+        len(data).to_bytes(4, "big") + data for data in bands
+    )
+
+def unpack_bands(data):
+    """Return the encoded bands of a page made by `pack_bands`, top to bottom."""
+    bands = []
+    position = len(BANDS_MAGIC)
+    while position < len(data):
+        length = int.from_bytes(data[position:position + 4], "big")
+        bands.append(data[position + 4:position + 4 + length])
+        position += 4 + length
+    return bands
+
+def encode_page(
+    image, quality=JPEG_QUALITY, bilevel=BILEVEL, grayscale=GRAYSCALE, target_bytes=None
+):
+    """Encode a rendered page, band by band for a `BandedPage`.
+
+    Returns `(data, quality)` like `encode_image_with_quality`. Bands share
+    `target_bytes` in proportion to their area, and the lowest quality of
+    any band is returned.
+    """
+    if isinstance(image, BandedPage):
+        width, height = image.size
+        bands = []
+        qualities = []
+        for band in image:
+            band_target = target_bytes and target_bytes * band.height // height
+            data, band_quality = encode_image_with_quality(
+                band, quality, bilevel, grayscale, band_target
+            )
+            bands.append(data)
+            qualities.append(band_quality)
+        known = [band_quality for band_quality in qualities if band_quality is not None]
+        return pack_bands(bands), min(known) if known else None
+    return encode_image_with_quality(image, quality, bilevel, grayscale, target_bytes)
+
+def encode_image_ladder(image, qualities=QUALITY_LEVELS, bilevel=BILEVEL, grayscale=GRAYSCALE):
+    """Encode a page once per quality and return the `(data, quality)` variants.
+
+    Bilevel pages have a single variant with quality None. The raster is
+    converted once and reused for every quality.
+    """
+    check_modes(bilevel, grayscale)
+    if bilevel == "force" or (bilevel == "auto" and is_bilevel(image)):
+        return [(encode_bilevel(image), None)]
+    if image.mode != "L" and (
+        grayscale == "force" or (grayscale == "auto" and is_grayscale(image))
+    ):
+        image = image.convert("L")
+    return [(encode_jpeg(image, quality), quality) for quality in qualities]
+
+def encode_page_ladder(image, qualities=QUALITY_LEVELS, bilevel=BILEVEL, grayscale=GRAYSCALE):
+    """Encode a rendered page at every quality, band by band for a `BandedPage`.
+
+    Returns the variants packed with `pack_ladder`.
+    """
+    if not isinstance(image, BandedPage):
+        return pack_ladder(encode_image_ladder(image, qualities, bilevel, grayscale))
+    bands = [encode_image_ladder(band, qualities, bilevel, grayscale) for band in image]
+    if all(len(band) == 1 for band in bands):
+        return pack_ladder([(pack_bands(band[0][0] for band in bands), None)])
+    return pack_ladder([
+        (pack_bands(band[min(index, len(band) - 1)][0] for band in bands), quality)
+        for index, quality in enumerate(qualities)
+    ])
+
+def pack_ladder(variants):
+    """Combine the `(data, quality)` variants of a page into a single encoded page."""
+    return LADDER_MAGIC + b"".join(
+        (quality or 0).to_bytes(1, "big") + len(data).to_bytes(4, "big") + data
+        for data, quality in variants
+    )
+
+def unpack_ladder(data):
+    """Return the `(data, quality)` variants of a page made by `pack_ladder`."""
+    variants = []
+    position = len(LADDER_MAGIC)
+    while position < len(data):
+        quality = data[position] or None
+        length = int.from_bytes(data[position + 1:position + 5], "big")
+        variants.append((data[position + 5:position + 5 + length], quality))
+        position += 5 + length
+    return variants
+
+def render_options(
+    dpi=DPI,
+    backend=BACKEND,
+    max_pixels=MAX_PIXELS,
+    bilevel=BILEVEL,
+    grayscale=GRAYSCALE,
+    band_pixels=BAND_PIXELS,
+    target_bytes=None,
+    qualities=None,
+):
+    """Options that affect the rendered pages, used to build cache keys."""
+    return {
+        "dpi": dpi,
+        "backend": backend,
+        "max_pixels": max_pixels,
+        "quality": JPEG_QUALITY,
+        "bilevel": bilevel,
+        "grayscale": grayscale,
+        "band_pixels": band_pixels,
+        "target_bytes": target_bytes,
+        "qualities": qualities,
+    }
+
+def iter_page_range(
+    pdf_path,
+    first_page=1,
+    last_page=None,
+    dpi=DPI,
+    backend=BACKEND,
+    max_pixels=MAX_PIXELS,
+    bilevel=BILEVEL,
+    grayscale=GRAYSCALE,
+    band_pixels=BAND_PIXELS,
+    target_bytes=None,
+    qualities=None,
+):
+    """Render and encode pages `first_page` to `last_page` one at a time.
+
+    Yields `(data, info)` pairs, where `info` holds the page number, the DPI
+    it was rendered at, render and encode times, the encoded size and the
+    JPEG quality (None for bilevel pages). With `target_bytes`, each page
+    gets the highest quality that fits that many bytes. With `qualities`,
+    each page is encoded at all of them and packed with `pack_ladder`, and
+    its quality is None until one variant is picked.
+    Bands of a `BandedPage` are rendered while it is encoded, so their
+    render time counts as encode time.
+    """
+    images = iter_images_from_pdf(
+        pdf_path,
+        dpi,
+        backend,
+        first_page=first_page,
+        last_page=last_page,
+        max_pixels=max_pixels,
+        gray=grayscale == "force",
+        band_pixels=band_pixels,
+    )
+    number = first_page
+    while True:
+        start = time.perf_counter()
+        image = next(images, None)
+        if image is None:
+            return
+        rendered = time.perf_counter()
+        if qualities:
+            data = encode_page_ladder(image, qualities, bilevel, grayscale)
+            quality = None
+        else:
+            data, quality = encode_page(
+                image, bilevel=bilevel, grayscale=grayscale, target_bytes=target_bytes
+            )
+        info = {
+            "page": number,
+            "dpi": image.info["dpi"][0],
+            "render_seconds": rendered - start,
+            "encode_seconds": time.perf_counter() - rendered,
+            "bytes": len(data),
+            "quality": quality,
+        }
+        image = None
+        yield data, info
+        number += 1
+
+def render_page_range(pdf_path, first_page, last_page, *args):
+    """Render and encode a range of pages; runs inside worker processes.
+
+    Takes the same arguments as `iter_page_range`.
+    """
+    return list(iter_page_range(pdf_path, first_page, last_page, *args))
+
+def plan_page_tasks(keys, page_cache=None, page_numbers=None):
+    """Split pages into cached pages and runs of at most PAGES_PER_JOB pages to render.
+
+    Only pages in `page_numbers` are planned, if given. Returns
+    `(first_page, last_page, cached)` tuples in page order.
+    """
+    tasks = []
+    for number, key in enumerate(keys, start=1):
+        if page_numbers is not None and number not in page_numbers:
+            continue
+        cached = page_cache is not None and key in page_cache
+        if cached or not tasks or tasks[-1][2] or tasks[-1][1] != number - 1:
+            tasks.append([number, number, cached])
+        elif tasks[-1][1] - tasks[-1][0] + 1 < PAGES_PER_JOB:
+            tasks[-1][1] = number
+        else:
+            tasks.append([number, number, cached])
+    return [tuple(task) for task in tasks]
+
+def iter_encoded_pages(
+    pdf_path,
+    dpi=DPI,
+    backend=BACKEND,
+    jobs=JOBS,
+    page_cache=None,
+    max_pixels=MAX_PIXELS,
+    bilevel=BILEVEL,
+    grayscale=GRAYSCALE,
+    band_pixels=BAND_PIXELS,
+    stats=None,
+    page_numbers=None,
+    target_bytes=None,
+    qualities=None,
+):
+    """Yield encoded pages in page order, rendering on `jobs` processes.
+
+    Each worker opens the document itself and renders `PAGES_PER_JOB` pages
+    per task. Only a bounded number of tasks is in flight at once so finished
+    pages don't pile up in the parent. With a `page_cache`, pages rendered
+    before (in any document) are read from the cache, and newly rendered
+    pages are added to it. Per-page timings are added to `stats` (a
+    `stats.FlattenStats`) if given. With `page_numbers`, only those pages
+    are yielded. `target_bytes` and `qualities` are passed on to
+    `iter_page_range`.
+    """
+    check_input(pdf_path)
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1")
+    check_modes(bilevel, grayscale)
+    get_renderer(backend)
+    options = (
+        dpi, backend, max_pixels, bilevel, grayscale, band_pixels, target_bytes, qualities
+    )
+
+    def generate(pdf_path):
+        from concurrent.futures import ProcessPoolExecutor
+
+        if page_cache is None and jobs == 1 and page_numbers is None:
+            for data, info in iter_page_range(pdf_path, 1, None, *options):
+                if stats is not None:
+                    stats.add_page(info)
+                yield data
+            return
+
+        if page_cache is not None:
+            keys = page_cache.keys(pdf_path, **render_options(*options))
+        else:
+            keys = [None] * get_page_count(pdf_path)
+
+        def cached_pages(number):
+            data = page_cache.get(keys[number - 1])
+            if data is None:
+                # Evicted since the tasks were planned
+                data, info = render_page_range(pdf_path, number, number, *options)[0]
+                page_cache.put(keys[number - 1], data)
+            else:
+                info = {"page": number, "cached": True, "bytes": len(data)}
+            if stats is not None:
+                stats.add_page(info)
+            yield data
+
+        def rendered_pages(first_page, pages):
+            for number, (data, info) in enumerate(pages, start=first_page):
+                if page_cache is not None:
+                    page_cache.misses += 1
+                    page_cache.put(keys[number - 1], data)
+                if stats is not None:
+                    stats.add_page(info)
+                yield data
+
+        def finished_pages(first_page, future):
+            if future is None:
+                return cached_pages(first_page)
+            return rendered_pages(first_page, future.result())
+
+        tasks = plan_page_tasks(keys, page_cache, page_numbers)
+
+        if jobs == 1:
+            for first_page, last_page, cached in tasks:
+                if cached:
+                    yield from cached_pages(first_page)
+                else:
+                    yield from rendered_pages(
+                        first_page,
+                        iter_page_range(pdf_path, first_page, last_page, *options),
+                    )
+            return
+
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        try:
+            pending = deque()
+            for first_page, last_page, cached in tasks:
+                future = None
+                if not cached:
+                    future = executor.submit(
+                        render_page_range, pdf_path, first_page, last_page, *options
+                    )
+                pending.append((first_page, future))
+                if len(pending) >= jobs * 2:
+                    yield from finished_pages(*pending.popleft())
+            while pending:
+                yield from finished_pages(*pending.popleft())
+        finally:
+            # Don't keep rendering pages nobody will consume after a failure
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def generate_from_temp_file():
+        # Workers open the document themselves; write it out once instead of
+        # pickling all of it into every task
+        with write_temp_pdf(pdf_path) as temp_path:
+            yield from generate(temp_path)
+
+    if jobs > 1 and is_pdf_data(pdf_path):
+        return generate_from_temp_file()
+    return generate(pdf_path)
+
+def insert_ccitt_image(doc, data, width, height, black_is_1):
+    """Add raw CCITT Group 4 data to `doc` as an image XObject and return its xref."""
+    xref = doc.get_new_xref()
+    doc.update_object(xref, "<<>>")
+    doc.update_stream(xref, data, new=1, compress=0)
+    for key, value in (
+        ("Type", "/XObject"),
+        ("Subtype", "/Image"),
+        ("Width", str(width)),
+        ("Height", str(height)),
+        ("BitsPerComponent", "1"),
+        ("ColorSpace", "/DeviceGray"),
+        ("Filter", "/CCITTFaxDecode"),
+        (
+            "DecodeParms",
+            f"<</K -1 /Columns {width} /Rows {height} "
+            f"/BlackIs1 {'true' if black_is_1 else 'false'}>>",
+        ),
+    ):
+        doc.xref_set_key(xref, key, value)
+    return xref
+
+def read_image_header(data):
+    """Return the size of an encoded image and, for G4 TIFF, its CCITT strip.
+
+    The strip is `(offset, length, black_is_1)`, or None for other formats.
+    """
+    from PIL import Image
+
+    # Image.open only parses the header; the pixels are never decoded here
+    with Image.open(io.BytesIO(data)) as image:
+        strip = None
+        if image.format == "TIFF" and image.info.get("compression") == "group4":
+            strip = (image.tag_v2[273][0], image.tag_v2[279][0], image.tag_v2.get(262) == 1)
+        return image.size, strip
+
+def insert_encoded_page(doc, data, size=None):
+    """Append a page showing an encoded image, keeping its compressed stream.
+
+    The page is `size`, a `(width, height)` in points such as the source
+    page's, with the image stretched over it; without `size` every pixel
+    is one point. JPEG data is embedded as a DCT stream. MuPDF would
+    decompress G4 TIFF data, so its strip is copied into a CCITTFax image
+    object instead. Banded pages get one image per band, stacked without
+    gaps.
+    """
+    import fitz
+
+    bands = unpack_bands(data) if data.startswith(BANDS_MAGIC) else [data]
+    headers = [read_image_header(band) for band in bands]
+    width = headers[0][0][0]
+    height = sum(size[1] for size, _ in headers)
+    page_width, page_height = size or (width, height)
+    scale_x = page_width / width
+    scale_y = page_height / height
+
+    page = doc.new_page(width=page_width, height=page_height)
+    top = 0
+    for band, ((band_width, band_height), strip) in zip(bands, headers):
+        rect = fitz.Rect(
+            0, top * scale_y, band_width * scale_x, (top + band_height) * scale_y
+        )
+        if strip:
+            offset, length, black_is_1 = strip
+            xref = insert_ccitt_image(
+                doc, band[offset:offset + length], band_width, band_height, black_is_1
+            )
+            page.insert_image(rect, xref=xref)
+        else:
+            page.insert_image(rect, stream=band)
+        top += band_height
+    return page
+
+def build_pdf_from_encoded_pages(pages, sizes=None):
+    """Assemble already-encoded pages into an in-memory document.
+
+    `sizes` gives every page's size in points (see `get_page_sizes`), so
+    pages rendered at any DPI keep the size of the source pages.
+    """
+    import fitz
+
+    doc = fitz.open()
+    try:
+        for number, data in enumerate(pages):
+            insert_encoded_page(doc, data, sizes[number] if sizes else None)
+    except Exception:
+        doc.close()
         raise
+    return doc
 
-def create_pdf_from_images(images, output_path):
+def build_partially_flattened_pdf(pdf_path, pages, page_numbers):
+    """Assemble a copy of `pdf_path` with only `page_numbers` replaced by encoded pages.
+
+    `pages` yields the encoded pages in order. All other pages are copied
+    with `insert_pdf`, so their text, vectors and annotations stay as they
+    are; consecutive copied pages are inserted in one call. Encoded pages
+    keep the size of the pages they replace.
+    """
+    import fitz
+
+    source = open_pdf(pdf_path)
+    doc = fitz.open()
     try:
-        doc = fitz.open()
-        
-        for image in images:
-            with safe_temp_file(suffix=".jpg") as temp_img_file_path:
-                image.save(temp_img_file_path, format="JPEG", quality=50)
-                img_pix = fitz.Pixmap(temp_img_file_path)
-                page = doc.new_page(width=img_pix.width, height=img_pix.height)
-                page.insert_image(page.rect, pixmap=img_pix)
-                img_pix = None
+        pages = iter(pages)
+        copy_from = None
+        for number in range(1, source.page_count + 2):
+            if number in page_numbers or number > source.page_count:
+                if copy_from is not None:
+                    # Keep the graft map between calls so shared resources are copied once
+                    doc.insert_pdf(
+                        source, from_page=copy_from - 1, to_page=number - 2, final=False
+                    )
+                    copy_from = None
+                if number <= source.page_count:
+                    rect = source[number - 1].rect
+                    insert_encoded_page(doc, next(pages), (rect.width, rect.height))
+            elif copy_from is None:
+                copy_from = number
+    except Exception:
+        doc.close()
+        raise
+    finally:
+        source.close()
+    return doc
+
+def allocate_qualities(ladders, budget):
+    """Pick one variant of every page so that their sizes add up to at most `budget`.
+
+    `ladders` holds the `(quality, size)` variants of each page in order of
+    increasing quality; bilevel pages have one variant with quality None.
+    The lowest quality of any page is made as high as possible first, then
+    the bytes left over raise the lowest pages one step at a time. Returns
+    the index of the chosen variant of every page; if not even the lowest
+    variants fit, every page gets its lowest.
+    """
+    import heapq
+
+    def index_at(ladder, level):
+        # The best variant of a page not above `level`
+        index = 0
+        for position, (quality, _) in enumerate(ladder):
+            if quality is not None and quality <= level:
+                index = position
+        return index
+
+    def total(choice):
+        return sum(ladder[index][1] for ladder, index in zip(ladders, choice))
+
+    choice = [0] * len(ladders)
+    levels = sorted({quality for ladder in ladders for quality, _ in ladder if quality})
+    for level in reversed(levels):
+        candidate = [index_at(ladder, level) for ladder in ladders]
+        if total(candidate) <= budget:
+            choice = candidate
+            break
 
+    remaining = budget - total(choice)
+    heap = [
+        (ladder[index][0], page)
+        for page, (ladder, index) in enumerate(zip(ladders, choice))
+        if index + 1 < len(ladder)
+    ]
+    heapq.heapify(heap)
+    while heap:
+        _, page = heapq.heappop(heap)
+        ladder = ladders[page]
+        cost = ladder[choice[page] + 1][1] - ladder[choice[page]][1]
+        if cost <= remaining:
+            choice[page] += 1
+            remaining -= cost
+            if choice[page] + 1 < len(ladder):
+                heapq.heappush(heap, (ladder[choice[page]][0], page))
+    return choice
+
+def build_pdf_within_size(pages, max_bytes, target_bytes=None, sizes=None):
+    """Assemble pages encoded by `encode_page_ladder` into a document of at most `max_bytes`.
+
+    The variants are spooled to a temporary file, so only their sizes are
+    kept in memory, and variants over `target_bytes` are dropped unless
+    they are a page's lowest. `allocate_qualities` picks the variants
+    within `max_bytes` less an estimate of the document's own overhead. If
+    the saved document still comes out too large, the budget is cut by the
+    overshoot and the pages are assembled again, up to
+    SIZE_LIMIT_ATTEMPTS times. `sizes` are the page sizes, as for
+    `build_pdf_from_encoded_pages`.
+
+    Returns the document and the chosen `(quality, size)` of every page.
+    """
+    with tempfile.TemporaryFile() as spool:
+        ladders = []
+        offsets = []
+        for data in pages:
+            variants = unpack_ladder(data)
+            if target_bytes:
+                variants = [
+                    variant for variant in variants if len(variant[0]) <= target_bytes
+                ] or variants[:1]
+            ladders.append([(quality, len(variant)) for variant, quality in variants])
+            offsets.append([])
+            for variant, _ in variants:
+                offsets[-1].append(spool.tell())
+                spool.write(variant)
+
+        def read(page, index):
+            spool.seek(offsets[page][index])
+            return spool.read(ladders[page][index][1])
+
+        budget = max_bytes - DOCUMENT_OVERHEAD_BYTES - PAGE_OVERHEAD_BYTES * len(ladders)
+        for attempt in range(SIZE_LIMIT_ATTEMPTS):
+            choice = allocate_qualities(ladders, budget)
+            doc = build_pdf_from_encoded_pages(
+                (read(page, index) for page, index in enumerate(choice)), sizes
+            )
+            if attempt + 1 == SIZE_LIMIT_ATTEMPTS or not any(choice):
+                break
+            size = len(doc.tobytes(**SAVE_OPTIONS))
+            if size <= max_bytes:
+                break
+            doc.close()
+            budget -= size - max_bytes
+    return doc, [ladders[page][index] for page, index in enumerate(choice)]
+
+def bake_pdf(pdf_path):
+    """Open `pdf_path` with form fields and annotations baked into the page content.
+
+    Their appearance streams become part of each page, so nothing stays
+    interactive while text and vectors are kept as they are.
+    """
+    doc = open_pdf(pdf_path)
+    try:
+        doc.bake(annots=True, widgets=True)
+    except Exception:
+        doc.close()
+        raise
+    return doc
+
+def create_pdf_from_encoded_pages(pages, output_path):
+    """Write already-encoded pages (any iterable of bytes) to a new PDF."""
+    try:
+        doc = build_pdf_from_encoded_pages(pages)
         doc.save(output_path)
         doc.close()
     except Exception as e:
         logger.error(f"Failed to create PDF from images: {e}")
         raise
 
+def create_pdf_from_images(images, output_path):
+    """Write `images` (any iterable, including a generator) to a new PDF."""
+    create_pdf_from_encoded_pages(
+        (encode_image(image) for image in images), output_path
+    )
+
+# Options used for the final, compressed write of a flattened document
+SAVE_OPTIONS = {"garbage": 4, "deflate": True, "clean": True}
+
 def compress_pdf(input_pdf, output_pdf):
+    import fitz
+
     try:
         doc = fitz.open(input_pdf)
-        doc.save(output_pdf, garbage=4, deflate=True, incremental=False, clean=True)
+        doc.save(output_pdf, incremental=False, **SAVE_OPTIONS)
         doc.close()
     except Exception as e:
         logger.error(f"Failed to compress PDF: {e}")
         raise
 
-def set_metadata(pdf_path, creation_date=None, modification_date=None):
-    try:
-        doc = fitz.open(pdf_path)
+def format_pdf_date(dt):
+    return dt.strftime("D:%Y%m%d%H%M%S+00'00'")
 
-        def format_date(dt):
-            return dt.strftime("D:%Y%m%d%H%M%S+00'00'")
+def build_metadata(creation_date=None, modification_date=None):
+    """Build the PDF metadata dictionary for YYYY-MM-DD date strings."""
+    new_metadata = {}
 
-        # Prepare the metadata dictionary
-        new_metadata = {}
+    if creation_date:
+        try:
+            creation_dt = datetime.strptime(creation_date, "%Y-%m-%d")
+            new_metadata["creationDate"] = format_pdf_date(creation_dt)
+        except ValueError:
+            logger.error("Invalid creation date format. Use YYYY-MM-DD.")
+            raise ValueError("Invalid creation date format. Use YYYY-MM-DD.")
 
-        if creation_date:
-            try:
-                creation_dt = datetime.strptime(creation_date, "%Y-%m-%d")
-                creation_str = format_date(creation_dt)
-                new_metadata["creationDate"] = creation_str
-            except ValueError:
-                logger.error("Invalid creation date format. Use YYYY-MM-DD.")
-                raise ValueError("Invalid creation date format. Use YYYY-MM-DD.")
-
-        if modification_date:
-            try:
-                modification_dt = datetime.strptime(modification_date, "%Y-%m-%d")
-                modification_str = format_date(modification_dt)
-                new_metadata["modDate"] = modification_str
-            except ValueError:
-                logger.error("Invalid modification date format. Use YYYY-MM-DD.")
-                raise ValueError("Invalid modification date format. Use YYYY-MM-DD.")
-
-        # Update metadata after compression
+    if modification_date:
+        try:
+            modification_dt = datetime.strptime(modification_date, "%Y-%m-%d")
+            new_metadata["modDate"] = format_pdf_date(modification_dt)
+        except ValueError:
+            logger.error("Invalid modification date format. Use YYYY-MM-DD.")
+            raise ValueError("Invalid modification date format. Use YYYY-MM-DD.")
+
+    return new_metadata
+
+def set_metadata(pdf_path, creation_date=None, modification_date=None):
+    import fitz
+
+    try:
+        new_metadata = build_metadata(creation_date, modification_date)
+
+        doc = fitz.open(pdf_path)
         doc.set_metadata(new_metadata)
         doc.save(pdf_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
         doc.close()
@@ -207,85 +1243,364 @@ def set_metadata(pdf_path, creation_date=None, modification_date=None):
         logger.error(f"Failed to set metadata: {e}")
         raise
 
+def resolve_dates(pdf_path, creation_date=None, modification_date=None):
+    """Work out the creation and modification datetimes of the flattened file.
+
+    Dates default to the original document's metadata (or its file times).
+    Requested YYYY-MM-DD dates keep the original time of day, and the
+    modification date is never earlier than the creation date. Documents
+    given as bytes have no file times and fall back to the current time.
+    """
+    # Retrieve the original file's metadata dates
+    doc = open_pdf(pdf_path)
+    original_metadata = doc.metadata
+    original_creation_date = original_metadata.get("creationDate", "")
+    original_modification_date = original_metadata.get("modDate", "")
+    doc.close()
+
+    # Extract and format the original creation and modification datetime if they exist
+    if original_creation_date:
+        original_creation_dt = datetime.strptime(
+            original_creation_date[2:16], "%Y%m%d%H%M%S"
+        )
+    elif is_pdf_data(pdf_path):
+        original_creation_dt = datetime.now()
+    else:
+        original_creation_dt = datetime.fromtimestamp(os.path.getctime(pdf_path))
+
+    if original_modification_date:
+        original_modification_dt = datetime.strptime(
+            original_modification_date[2:16], "%Y%m%d%H%M%S"
+        )
+    elif is_pdf_data(pdf_path):
+        original_modification_dt = original_creation_dt
+    else:
+        original_modification_dt = datetime.fromtimestamp(os.path.getmtime(pdf_path))
+
+    # Use original hours and minutes if only the date part is provided
+    if creation_date:
+        creation_date = datetime.strptime(creation_date, "%Y-%m-%d")
+        creation_dt = creation_date.replace(
+            hour=original_creation_dt.hour,
+            minute=original_creation_dt.minute,
+            second=original_creation_dt.second,
+        )
+    else:
+        creation_dt = original_creation_dt
+
+    if modification_date:
+        modification_date = datetime.strptime(modification_date, "%Y-%m-%d")
+        modification_dt = modification_date.replace(
+            hour=original_modification_dt.hour,
+            minute=original_modification_dt.minute,
+            second=original_modification_dt.second,
+        )
+    else:
+        modification_dt = original_modification_dt
+
+    # Ensure modification date is not earlier than the creation date
+    if modification_dt < creation_dt:
+        modification_dt = creation_dt
+
+    return creation_dt, modification_dt
+
+@contextmanager
+def atomic_output(output_path):
+    """Yield a temporary path next to `output_path` and move it into place on success.
+
+    The temporary file lives in the destination directory, so the final
+    rename never has to copy data across filesystems.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(prefix=".flat-", suffix=".pdf", dir=output_dir)
+    os.close(fd)
+    try:
+        yield temp_path
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            try:
+                os.remove(temp_path)
+            except OSError as e:
+                logger.warning(f"Failed to remove temporary file {temp_path}: {e}")
+
+def is_stream(output):
+    """Return True if `output` is a writable binary file object rather than a path."""
+    return hasattr(output, "write")
+
+def save_flattened_pdf(doc, output_path, creation_dt, modification_dt):
+    """Set the metadata dates and write `doc` to `output_path` in a single save.
+
+    `output_path` may also be a binary file object, in which case the saved
+    bytes are written to it and returned.
+    """
+    doc.set_metadata(
+        build_metadata(
+            creation_dt.strftime("%Y-%m-%d"), modification_dt.strftime("%Y-%m-%d")
+        )
+    )
+    if is_stream(output_path):
+        data = doc.tobytes(**SAVE_OPTIONS)
+        output_path.write(data)
+        return data
+    with atomic_output(output_path) as temp_output_path:
+        doc.save(temp_output_path, **SAVE_OPTIONS)
+    return None
+
+def materialize_cached_pdf(cache, key, output_path, creation_dt, modification_dt):
+    """Write the cached result for `key` to `output_path` with the given dates.
+
+    Returns False, leaving `output_path` untouched, on a cache miss.
+    """
+    from .cache import CacheMiss
+
+    if is_stream(output_path):
+        try:
+            data = cache.read(key)
+        except CacheMiss:
+            return False
+        doc = open_pdf(data)
+        try:
+            save_flattened_pdf(doc, output_path, creation_dt, modification_dt)
+        finally:
+            doc.close()
+        return True
+
+    try:
+        with atomic_output(output_path) as temp_output_path:
+            cache.fetch(key, temp_output_path)
+            set_metadata(
+                temp_output_path,
+                creation_dt.strftime("%Y-%m-%d"),
+                modification_dt.strftime("%Y-%m-%d"),
+            )
+    except CacheMiss:
+        return False
+    return True
+
 def flatten_pdf(
-    pdf_path, output_path, creation_date=None, modification_date=None, dpi=DPI
+    pdf_path,
+    output_path,
+    creation_date=None,
+    modification_date=None,
+    dpi=DPI,
+    backend=BACKEND,
+    jobs=JOBS,
+    cache_dir=None,
+    cache_max_mb=None,
+    page_cache=None,
+    max_pixels=MAX_PIXELS,
+    max_memory_mb=None,
+    bilevel=BILEVEL,
+    grayscale=GRAYSCALE,
+    band_pixels=BAND_PIXELS,
+    work_dir=None,
+    select=SELECT,
+    pages=None,
+    mode=MODE,
+    target_page_kb=None,
+    max_output_mb=None,
 ):
-    if not os.path.exists(pdf_path):
-        raise FileNotFoundError(f"Input PDF file not found: {pdf_path}")
+    """Flatten `pdf_path` into an image-only PDF at `output_path`.
+
+    `pdf_path` may also be the bytes of a PDF, and `output_path` a binary
+    file object to write the result to; see also `flatten_bytes`.
+
+    With `cache_dir`, flattened documents are cached on disk keyed on the
+    input bytes and the rendering options; a cache hit skips rendering and
+    only applies the requested dates. `page_cache` (a `cache.PageCache`)
+    reuses individual pages rendered before, across documents.
+
+    `max_pixels` and `max_memory_mb` bound the raster of a single page;
+    pages that would exceed them are rendered at a lower DPI.
+
+    `bilevel` is "off", "auto" (store pages that are black on white as
+    1-bit CCITT G4 images) or "force" (threshold every page). `grayscale`
+    is "off", "auto" (store pages without color as gray JPEGs) or "force"
+    (render every page in DeviceGray).
+
+    With the MuPDF backend, pages larger than `band_pixels` are rendered
+    and stored in horizontal bands, so the memory needed for a page depends
+    on the band size rather than the page area.
+
+    With `work_dir`, every encoded page is saved there as soon as it is
+    rendered (see `cache.Checkpoint`). If flattening is interrupted, calling
+    it again with the same input and options renders only the missing
+    pages. The saved pages are removed once the output is written.
+
+    `select="auto"` rasterizes only pages with form fields, annotations or
+    optional content, and `pages` (a range like "1-3,7" or page numbers)
+    adds pages to rasterize; with just `pages`, only those are rasterized.
+    All other pages are copied unchanged, keeping their text and vectors.
+
+    With `mode="bake"`, nothing is rendered: form fields and annotations are
+    burned into the page content (see `bake_pdf`) and the document keeps
+    its text, vectors and metadata. Rendering options are then ignored.
+
+    With `target_page_kb`, every JPEG page gets the highest quality that
+    keeps it within that size instead of the fixed JPEG_QUALITY; the
+    chosen quality of each page is in the returned stats. With
+    `max_output_mb`, every page is encoded at each of QUALITY_LEVELS
+    (on `jobs` processes) and `build_pdf_within_size` picks per-page
+    qualities that keep the file within the limit, raising the lowest
+    page quality as far as possible. If even the lowest qualities don't
+    fit, the limit is exceeded with a warning.
+
+    Returns a `stats.FlattenStats` with the time spent in each stage, the
+    DPI and timings of every page, sizes and the peak RSS.
+    """
+    from .stats import FlattenStats, peak_rss_bytes
+
+    check_input(pdf_path)
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1")
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of: {', '.join(MODES)}")
+    if max_output_mb and (mode == "bake" or select != "all" or pages is not None):
+        raise ValueError("max_output_mb can only be used when every page is rasterized")
     
+    max_pixels = get_pixel_budget(max_pixels, max_memory_mb)
+    stats = FlattenStats(dpi)
+    stats.input_bytes = len(pdf_path) if is_pdf_data(pdf_path) else os.path.getsize(pdf_path)
+
     try:
-        with safe_temp_file(suffix=".pdf") as temp_output_path:
-            images = extract_images_from_pdf(pdf_path, dpi)
-            create_pdf_from_images(images, temp_output_path)
-
-            with safe_temp_file(suffix=".pdf") as compressed_output_path:
-                compress_pdf(temp_output_path, compressed_output_path)
-
-                # Retrieve the original file's metadata dates
-                doc = fitz.open(pdf_path)
-                original_metadata = doc.metadata
-                original_creation_date = original_metadata.get("creationDate", "")
-                original_modification_date = original_metadata.get("modDate", "")
-                doc.close()
+        with stats.measure("prepare"):
+            creation_dt, modification_dt = resolve_dates(
+                pdf_path, creation_date, modification_date
+            )
+            page_numbers = checkpoint = None
+            if mode == "rasterize":
+                page_numbers = select_pages(pdf_path, select, pages)
+            target_bytes = int(target_page_kb * 1024) if target_page_kb else None
+            # With an output limit, every page is encoded at several qualities
+            # and the limit is shared out once all of them are known
+            qualities = QUALITY_LEVELS if max_output_mb else None
 
-                # Extract and format the original creation and modification datetime if they exist
-                if original_creation_date:
-                    original_creation_dt = datetime.strptime(
-                        original_creation_date[2:16], "%Y%m%d%H%M%S"
-                    )
+        cache = cache_key = None
+        if cache_dir:
+            from .cache import CACHE_MAX_MB, ResultCache
+
+            max_mb = CACHE_MAX_MB if cache_max_mb is None else cache_max_mb
+            cache = ResultCache(cache_dir, int(max_mb * 1024 * 1024))
+            with stats.measure("cache"):
+                # Everything that changes the rendered output must be part of the key
+                if mode == "bake":
+                    cache_key = cache.key(pdf_path, mode=mode)
                 else:
-                    original_creation_dt = datetime.fromtimestamp(os.path.getctime(pdf_path))
+                    cache_key = cache.key(
+                        pdf_path,
+                        **render_options(
+                            dpi,
+                            backend,
+                            max_pixels,
+                            bilevel,
+                            grayscale,
+                            band_pixels,
+                            target_bytes,
+                            qualities,
+                        ),
+                        pages=None if page_numbers is None else sorted(page_numbers),
+                        max_output_mb=max_output_mb,
+                    )
+                stats.cache_hit = materialize_cached_pdf(
+                    cache, cache_key, output_path, creation_dt, modification_dt
+                )
+
+        if stats.cache_hit:
+            logger.info(f"Using cached result for {pdf_path}")
+        elif mode == "bake":
+            with stats.measure("bake"):
+                doc = bake_pdf(pdf_path)
+        else:
+            if work_dir:
+                from .cache import Checkpoint
 
-                if original_modification_date:
-                    original_modification_dt = datetime.strptime(
-                        original_modification_date[2:16], "%Y%m%d%H%M%S"
+                checkpoint = Checkpoint(work_dir, page_cache)
+            encoded_pages = iter_encoded_pages(
+                pdf_path,
+                dpi,
+                backend,
+                jobs,
+                checkpoint or page_cache,
+                max_pixels,
+                bilevel,
+                grayscale,
+                band_pixels,
+                stats,
+                page_numbers,
+                None if qualities else target_bytes,
+                qualities,
+            )
+            with stats.measure("assemble"):
+                if qualities:
+                    doc, chosen = build_pdf_within_size(
+                        stats.timed("render", encoded_pages),
+                        int(max_output_mb * 1024 * 1024),
+                        target_bytes,
+                        get_page_sizes(pdf_path),
                     )
-                else:
-                    original_modification_dt = datetime.fromtimestamp(os.path.getmtime(pdf_path))
-
-                # Use original hours and minutes if only the date part is provided
-                if creation_date:
-                    creation_date = datetime.strptime(creation_date, "%Y-%m-%d")
-                    creation_dt = creation_date.replace(
-                        hour=original_creation_dt.hour,
-                        minute=original_creation_dt.minute,
-                        second=original_creation_dt.second,
+                    for page, (quality, size) in zip(stats.pages, chosen):
+                        page.update(quality=quality, bytes=size)
+                elif page_numbers is None:
+                    doc = build_pdf_from_encoded_pages(
+                        stats.timed("render", encoded_pages), get_page_sizes(pdf_path)
                     )
                 else:
-                    creation_dt = original_creation_dt
-
-                if modification_date:
-                    modification_date = datetime.strptime(modification_date, "%Y-%m-%d")
-                    modification_dt = modification_date.replace(
-                        hour=original_modification_dt.hour,
-                        minute=original_modification_dt.minute,
-                        second=original_modification_dt.second,
+                    doc = build_partially_flattened_pdf(
+                        pdf_path, stats.timed("render", encoded_pages), page_numbers
                     )
-                else:
-                    modification_dt = original_modification_dt
-
-                # Ensure modification date is not earlier than the creation date
-                if modification_dt < creation_dt:
-                    modification_dt = creation_dt
-
-                # Set metadata after compression
-                set_metadata(
-                    compressed_output_path,
-                    creation_dt.strftime("%Y-%m-%d"),
-                    modification_dt.strftime("%Y-%m-%d"),
-                )
+                    stats.copied_pages = doc.page_count - len(page_numbers)
 
-                # Move final compressed and metadata-set file to the intended output location
-                shutil.move(compressed_output_path, output_path)
+        if not stats.cache_hit:
+            try:
+                with stats.measure("save"):
+                    data = save_flattened_pdf(
+                        doc, output_path, creation_dt, modification_dt
+                    )
+            finally:
+                doc.close()
+            if cache:
+                with stats.measure("cache"):
+                    if data is None:
+                        cache.store(cache_key, output_path)
+                    else:
+                        cache.store_bytes(cache_key, data)
+            if data is not None:
+                stats.output_bytes = len(data)
+            if checkpoint:
+                checkpoint.clear()
 
-                # Set file system times if creation/modification dates are provided
-                set_file_times(output_path, creation_dt, modification_dt)
+        if not is_stream(output_path):
+            # Set file system times if creation/modification dates are provided
+            set_file_times(output_path, creation_dt, modification_dt)
+            stats.output_bytes = os.path.getsize(output_path)
+        if max_output_mb and stats.output_bytes > max_output_mb * 1024 * 1024:
+            logger.warning(
+                f"Flattened PDF is {stats.output_bytes} bytes, over the {max_output_mb} MB "
+                f"limit even at the lowest JPEG quality"
+            )
 
     except Exception as e:
         logger.error(f"Failed to flatten PDF: {e}")
         raise
 
+    stats.peak_rss_bytes = peak_rss_bytes()
+    return stats
+
+def flatten_bytes(data, **options):
+    """Flatten a PDF held in memory and return the flattened PDF as bytes.
+
+    Takes the same options as `flatten_pdf`. With the MuPDF backend and a
+    single job nothing touches the filesystem; Poppler and worker processes
+    read the document from a temporary file.
+    """
+    output = io.BytesIO()
+    flatten_pdf(data, output, **options)
+    return output.getvalue()
+
 def set_file_times(file_path, creation_dt, modification_dt):
+    import subprocess
+
     # Apply modification and access times
     mod_timestamp = modification_dt.timestamp()
     os.utime(file_path, (mod_timestamp, mod_timestamp))
@@ -302,15 +1617,146 @@ def set_file_times(file_path, creation_dt, modification_dt):
             print(f"Error setting file creation date: {e}")
 
 
-def parse_arguments():
+def glob_root(pattern):
+    """Return the leading directories of a glob pattern that contain no wildcards."""
+    root = os.path.dirname(pattern)
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or "."
+
+def collect_input_paths(inputs):
+    """Expand files, directories and glob patterns into input PDFs.
+
+    Returns a list of `(pdf_path, relative_path)` pairs. `relative_path` is
+    the path the output should get below the output directory: the file name
+    for files, the path relative to the directory for PDFs found by walking a
+    directory recursively, and the path relative to the pattern's leading
+    directories without wildcards for glob matches, so `cases/*/exhibit.pdf`
+    keeps the folder that tells the matches apart. Paths that match nothing
+    are kept as they are so the failure shows up in the batch summary.
+    """
+    found = []
+    seen = set()
+
+    def add(pdf_path, relative_path):
+        key = os.path.abspath(pdf_path)
+        if key not in seen:
+            seen.add(key)
+            found.append((pdf_path, relative_path))
+
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(".pdf"):
+                        pdf_path = os.path.join(root, name)
+                        add(pdf_path, os.path.relpath(pdf_path, item))
+        elif not os.path.exists(item) and glob.has_magic(item):
+            root = glob_root(item)
+            for pdf_path in sorted(glob.glob(item, recursive=True)):
+                if os.path.isfile(pdf_path):
+                    add(pdf_path, os.path.relpath(pdf_path, root))
+        else:
+            add(item, os.path.basename(item))
+
+    return found
+
+def get_output_path(relative_path, output_dir="."):
+    directory, name = os.path.split(relative_path)
+    return os.path.join(output_dir, directory, f"flat-{name}")
+
+def flatten_one(pdf_path, output_path, options):
+    """Flatten a single file of a batch, reporting failures instead of raising."""
+    try:
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        flatten_pdf(pdf_path, output_path, **options)
+        return pdf_path, output_path, None
+    except Exception as e:
+        return pdf_path, output_path, f"{type(e).__name__}: {e}"
+
+def flatten_many(files, workers=WORKERS, **options):
+    """Flatten many `(pdf_path, output_path)` pairs on a pool of worker processes.
+
+    Worker processes are reused for every file, so the interpreter start-up
+    and imports are paid once per worker rather than once per file. Yields
+    `(pdf_path, output_path, error)` tuples as files finish; `error` is None
+    on success. A failing file never stops the rest of the batch.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    files = deque(files)
+    if workers == 1:
+        while files:
+            pdf_path, output_path = files.popleft()
+            yield flatten_one(pdf_path, output_path, options)
+        return
+
+    while files:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        pending = {}
+        try:
+            while files or pending:
+                while files and len(pending) < workers * 2:
+                    pdf_path, output_path = files[0]
+                    future = executor.submit(flatten_one, pdf_path, output_path, options)
+                    files.popleft()
+                    pending[future] = (pdf_path, output_path)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pdf_path, output_path = pending.pop(future)
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool as e:
+                        yield pdf_path, output_path, f"{type(e).__name__}: {e}"
+        except BrokenProcessPool:
+            # A worker died hard (e.g. crashed inside a native library). Report
+            # the files it may have been handling and carry on with a fresh pool.
+            for pdf_path, output_path in pending.values():
+                yield pdf_path, output_path, "BrokenProcessPool: worker process died"
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def parse_arguments(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(
-        description="Flatten a PDF and optionally set metadata."
+        description="Flatten PDFs and optionally set metadata."
     )
 
-    parser.add_argument("input_pdf", help="Path to the input PDF file")
-    parser.add_argument("--output", "-o", help="Output PDF file name", default=None)
+    parser.add_argument(
+        "input_pdfs",
+        nargs="+",
+        metavar="input_pdf",
+        help="Input PDF files, directories (searched recursively) or glob patterns; "
+        "- reads a single PDF from stdin",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Output PDF file name, or - for stdout (single input only)",
+        default=None,
+    )
+    parser.add_argument(
+        "--output-dir",
+        "-O",
+        help="Directory for flattened files (default: current directory)",
+        default=None,
+    )
+    parser.add_argument(
+        "--mode",
+        choices=MODES,
+        help="rasterize pages to images, or bake form fields and annotations into the "
+        "page content, keeping text and vectors (default: rasterize)",
+        default=MODE,
+    )
     parser.add_argument(
         "--dpi",
         "-d",
@@ -318,6 +1764,138 @@ def parse_arguments():
         help="DPI for image extraction (default: 200)",
         default=200,
     )
+    parser.add_argument(
+        "--backend",
+        "-b",
+        choices=sorted(RENDERERS),
+        help="Rendering backend: poppler (pdftoppm) or mupdf (in-process) (default: poppler)",
+        default=BACKEND,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Number of processes used to render pages (default: 1)",
+        default=JOBS,
+    )
+    parser.add_argument(
+        "--bilevel",
+        choices=BILEVEL_MODES,
+        help="Store black-on-white pages as 1-bit CCITT G4 images: off, auto (detect) "
+        "or force (default: off)",
+        default=BILEVEL,
+    )
+    parser.add_argument(
+        "--grayscale",
+        choices=GRAYSCALE_MODES,
+        help="Store pages as gray JPEGs: off, auto (pages without color) or force "
+        "(render in DeviceGray) (default: off)",
+        default=GRAYSCALE,
+    )
+    parser.add_argument(
+        "--target-page-kb",
+        type=float,
+        help="Encode each page at the highest JPEG quality that keeps it within this size",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-output-mb",
+        type=float,
+        help="Keep the output within this size, choosing per-page JPEG qualities that make "
+        "the lowest page quality as high as possible",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-pixels",
+        type=int,
+        help=f"Largest raster for one page; bigger pages get a lower DPI, 0 disables (default: {MAX_PIXELS})",
+        default=MAX_PIXELS,
+    )
+    parser.add_argument(
+        "--max-page-memory-mb",
+        type=float,
+        help="Largest raster for one page in MB; bigger pages get a lower DPI",
+        default=None,
+    )
+    parser.add_argument(
+        "--band-pixels",
+        type=int,
+        help="Render pages with more pixels than this in horizontal bands of at most "
+        "this many pixels (mupdf backend only)",
+        default=BAND_PIXELS,
+    )
+    parser.add_argument(
+        "--select",
+        choices=SELECT_MODES,
+        help="Pages to rasterize: all, or auto (pages with form fields, annotations or "
+        "optional content); other pages are copied unchanged (default: all)",
+        default=SELECT,
+    )
+    parser.add_argument(
+        "--pages",
+        help='Rasterize these pages, e.g. "1-3,7,10-", and copy the rest unchanged',
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="Number of files flattened in parallel in batch mode (default: 1)",
+        default=WORKERS,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache flattened files in this directory and reuse them for identical inputs",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        help="Maximum cache size in MB; least recently used entries are evicted (default: 1024)",
+        default=None,
+    )
+    parser.add_argument(
+        "--page-cache-dir",
+        help="Cache rendered pages in this directory and reuse them across documents",
+        default=None,
+    )
+    parser.add_argument(
+        "--page-cache-max-mb",
+        type=float,
+        help="Maximum page cache size in MB (default: 1024)",
+        default=None,
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="Save rendered pages in this directory as they are done, so an interrupted "
+        "run can be resumed (single input only)",
+        default=None,
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the time spent in each stage, per-page timings and peak memory to stderr",
+    )
+    parser.add_argument(
+        "--stats-json",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="Write the statistics as JSON to FILE, or to stdout if no FILE is given",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        choices=("cpu", "mem"),
+        help="Profile the run: cpu writes a cProfile dump and a speedscope flame graph, "
+        "mem writes the top Python allocations of each stage",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile-output",
+        help="Path prefix for profile files (default: flatten-profile)",
+        default="flatten-profile",
+    )
     parser.add_argument(
         "--creation-date", "-c", help="Creation date in YYYY-MM-DD format", default=None
     )
@@ -328,22 +1906,155 @@ def parse_arguments():
         default=None,
     )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.output and args.output_dir:
+        parser.error("--output and --output-dir cannot be used together")
+    if args.output and (len(args.input_pdfs) > 1 or os.path.isdir(args.input_pdfs[0])):
+        parser.error("--output can only be used with a single input file")
+    if "-" in args.input_pdfs and (len(args.input_pdfs) > 1 or args.output_dir):
+        parser.error("- (stdin) can only be used as the single input file")
+    writes_stdout = args.output == "-" or (args.input_pdfs == ["-"] and not args.output)
+    if args.stats_json == "-" and writes_stdout:
+        parser.error("--stats-json needs a file name when the PDF is written to stdout")
+    if (args.stats or args.stats_json or args.profile or args.work_dir) and (
+        args.output_dir or len(args.input_pdfs) > 1 or os.path.isdir(args.input_pdfs[0])
+    ):
+        parser.error(
+            "--stats, --stats-json, --profile and --work-dir can only be used with a "
+            "single input file"
+        )
+    return args
+
+
+def run_batch(inputs, output_dir, workers, options):
+    files = [
+        (pdf_path, get_output_path(relative_path, output_dir))
+        for pdf_path, relative_path in collect_input_paths(inputs)
+    ]
+    if not files:
+        print("No PDF files found.", file=sys.stderr)
+        return 1
+
+    # Inputs with the same name in different places would overwrite each other
+    failed = 0
+    claimed = {}
+    unique = []
+    for pdf_path, output_path in files:
+        key = os.path.normcase(os.path.abspath(output_path))
+        if key in claimed:
+            failed += 1
+            print(f"FAILED {pdf_path}: {output_path} is also the output of {claimed[key]}")
+        else:
+            claimed[key] = pdf_path
+            unique.append((pdf_path, output_path))
+
+    for pdf_path, output_path, error in flatten_many(unique, workers, **options):
+        if error:
+            failed += 1
+            print(f"FAILED {pdf_path}: {error}")
+        else:
+            print(f"OK     {pdf_path} -> {output_path}")
+
+    print(f"{len(files) - failed} succeeded, {failed} failed.")
+    return 1 if failed else 0
+
+
+def configure_logging():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def main(argv=None):
+    configure_logging()
 
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["serve"]:
+        from .server import main as serve
 
-def main():
-    args = parse_arguments()
+        return serve(argv[1:])
 
-    input_pdf = args.input_pdf
-    output_pdf = args.output if args.output else f"flat-{os.path.basename(input_pdf)}"
-    creation_date = args.creation_date
-    modification_date = args.modification_date
-    dpi = args.dpi
+    args = parse_arguments(argv)
 
-    flatten_pdf(input_pdf, output_pdf, creation_date, modification_date, dpi)
+    options = {
+        "creation_date": args.creation_date,
+        "modification_date": args.modification_date,
+        "dpi": args.dpi,
+        "backend": args.backend,
+        "jobs": args.jobs,
+        "max_pixels": args.max_pixels,
+        "max_memory_mb": args.max_page_memory_mb,
+        "bilevel": args.bilevel,
+        "grayscale": args.grayscale,
+        "band_pixels": args.band_pixels,
+        "cache_dir": args.cache_dir,
+        "cache_max_mb": args.cache_max_mb,
+        "page_cache": None,
+        "work_dir": args.work_dir,
+        "select": args.select,
+        "pages": args.pages,
+        "mode": args.mode,
+        "target_page_kb": args.target_page_kb,
+        "max_output_mb": args.max_output_mb,
+    }
+    if args.page_cache_dir:
+        from .cache import CACHE_MAX_MB, PageCache
 
-    print(f"File {output_pdf} saved successfully.")
+        max_mb = CACHE_MAX_MB if args.page_cache_max_mb is None else args.page_cache_max_mb
+        options["page_cache"] = PageCache(args.page_cache_dir, int(max_mb * 1024 * 1024))
+
+    inputs = args.input_pdfs
+    is_pattern = not os.path.exists(inputs[0]) and glob.has_magic(inputs[0])
+    if len(inputs) > 1 or args.output_dir or os.path.isdir(inputs[0]) or is_pattern:
+        sys.exit(run_batch(inputs, args.output_dir or ".", args.workers, options))
+
+    input_pdf = inputs[0]
+    if input_pdf == "-":
+        output_pdf = args.output or "-"
+        source = sys.stdin.buffer.read()
+    else:
+        output_pdf = args.output or f"flat-{os.path.basename(input_pdf)}"
+        source = input_pdf
+    output = sys.stdout.buffer if output_pdf == "-" else output_pdf
+
+    if args.profile == "cpu":
+        from .profiling import profile_cpu
+
+        profile_path = f"{args.profile_output}.prof"
+        speedscope_path = f"{args.profile_output}.speedscope.json"
+        with profile_cpu(profile_path, speedscope_path):
+            stats = flatten_pdf(source, output, **options)
+        logger.info(f"CPU profile written to {profile_path} and {speedscope_path}")
+    elif args.profile == "mem":
+        from .profiling import profile_memory
+
+        profile_path = f"{args.profile_output}-memory.txt"
+        with profile_memory(profile_path):
+            stats = flatten_pdf(source, output, **options)
+        logger.info(f"Memory profile written to {profile_path}")
+    else:
+        stats = flatten_pdf(source, output, **options)
+
+    page_cache = options["page_cache"]
+    if page_cache:
+        logger.info(f"Page cache: {page_cache.hits} hits, {page_cache.misses} misses")
+    if args.stats:
+        print(stats.format(), file=sys.stderr)
+    if args.stats_json:
+        report = json.dumps(stats.to_dict(), indent=2)
+        if args.stats_json == "-":
+            print(report)
+        else:
+            with open(args.stats_json, "w") as f:
+                f.write(report + "\n")
+    if output_pdf == "-":
+        sys.stdout.buffer.flush()
+    else:
+        print(f"File {output_pdf} saved successfully.")
 
 
 if __name__ == "__main__":
+    import multiprocessing
+
+    # Needed for worker processes in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
     main()
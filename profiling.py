@@ -0,0 +1,196 @@
+"""CPU and memory profiling of flattening, without extra tools.
+
+``profile_cpu`` records a cProfile dump that can be turned into a
+speedscope (https://www.speedscope.app) flame graph, and ``profile_memory``
+reports the largest Python allocations of each pipeline stage with
+tracemalloc. Both profile the calling process only; render workers started
+with ``jobs > 1`` are not included.
+"""
+
+import json
+import os
+import tracemalloc
+from contextlib import contextmanager
+
+from . import stats
+
+# Allocation sites listed per stage in memory reports
+TOP_ALLOCATIONS = 10
+# Frames kept per allocation; more frames make snapshots slower
+TRACEMALLOC_FRAMES = 1
+# Calls shorter than this share of the total are left out of flame graphs
+MIN_SHARE = 0.0001
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+def pstats_to_speedscope(profile_path, output_path, name=None):
+    """Convert a cProfile dump to a speedscope evented profile.
+
+    cProfile only records caller/callee pairs, not whole stacks, so the call
+    tree is rebuilt from the roots down, splitting a function's time between
+    its callees in proportion to their cumulative times (as flameprof and
+    gprof2dot do). Recursive calls are cut at the first repetition.
+    """
+    import pstats
+
+    functions = pstats.Stats(profile_path).stats
+    callees = {}
+    for function, (_, _, _, _, callers) in functions.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((function, cumulative))
+    roots = [
+        function for function, (_, _, _, _, callers) in functions.items()
+        if not any(caller in functions for caller in callers)
+    ]
+    total = sum(functions[root][3] for root in roots)
+
+    frames = []
+    frame_index = {}
+    events = []
+
+    def frame(function):
+        if function not in frame_index:
+            file, line, function_name = function
+            frame_index[function] = len(frames)
+            frames.append({"name": function_name, "file": file, "line": line})
+        return frame_index[function]
+
+    def emit(function, start, duration, stack):
+        index = frame(function)
+        events.append({"type": "O", "frame": index, "at": start})
+        cumulative = functions[function][3]
+        scale = duration / cumulative if cumulative else 0
+        at = start
+        for callee, edge_time in sorted(callees.get(function, ()), key=lambda c: -c[1]):
+            child = min(edge_time * scale, start + duration - at)
+            if callee in stack or child < total * MIN_SHARE:
+                continue
+            emit(callee, at, child, stack | {callee})
+            at += child
+        events.append({"type": "C", "frame": index, "at": start + duration})
+
+    at = 0.0
+    for root in sorted(roots, key=lambda root: -functions[root][3]):
+        duration = functions[root][3]
+        if duration >= total * MIN_SHARE:
+            emit(root, at, duration, {root})
+            at += duration
+
+    profile = {
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "name": name or os.path.basename(profile_path),
+        "exporter": "pdf-flattener",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "evented",
+                "name": name or os.path.basename(profile_path),
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": at,
+                "events": events,
+            }
+        ],
+    }
+    with open(output_path, "w") as f:
+        json.dump(profile, f)
+
+
+@contextmanager
+def profile_cpu(output_path, speedscope_path=None):
+    """Profile the block with cProfile and write the dump to `output_path`.
+
+    The dump can be read with `pstats`, snakeviz or flameprof. With
+    `speedscope_path`, a speedscope flame graph is written as well.
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+        if speedscope_path:
+            pstats_to_speedscope(output_path, speedscope_path)
+
+
+class MemoryProfile:
+    """Python allocations per pipeline stage, collected with tracemalloc.
+
+    At every stage change a snapshot is compared with the previous one and
+    the growth is charged to the stage that just ran, so `sites[stage]`
+    holds the net bytes allocated at each source line while that stage ran.
+    Only allocations made through Python's allocator are traced; pixel
+    buffers owned by MuPDF and Pillow are not.
+    `peaks[stage]` is the largest traced memory seen during the stage.
+    """
+
+    def __init__(self, top=TOP_ALLOCATIONS):
+        self.top = top
+        self.sites = {}
+        self.peaks = {}
+        self.snapshot = None
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.snapshot = self.take_snapshot()
+        stats.add_stage_hook(self.on_stage_change)
+
+    def stop(self):
+        stats.remove_stage_hook(self.on_stage_change)
+        self.on_stage_change(stats.NO_STAGE, None)
+        tracemalloc.stop()
+
+    def take_snapshot(self):
+        # Leave out the memory held by the profiler and its snapshots
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+
+    def on_stage_change(self, finished, started):
+        """Charge allocations since the last change to the `finished` stage."""
+        _, peak = tracemalloc.get_traced_memory()
+        self.peaks[finished] = max(self.peaks.get(finished, 0), peak)
+        snapshot = self.take_snapshot()
+        sites = self.sites.setdefault(finished, {})
+        for difference in snapshot.compare_to(self.snapshot, "lineno"):
+            if difference.size_diff:
+                site = str(difference.traceback[0])
+                sites[site] = sites.get(site, 0) + difference.size_diff
+        self.snapshot = snapshot
+        tracemalloc.reset_peak()
+
+    def format(self):
+        """Return the report: peak and top allocation sites of each stage."""
+        lines = []
+        for stage, sites in self.sites.items():
+            lines.append(
+                f"{stage}: peak {self.peaks.get(stage, 0) / 1024 / 1024:.1f} MB traced"
+            )
+            top = sorted(sites.items(), key=lambda site: -site[1])[:self.top]
+            for site, size in top:
+                if size > 0:
+                    lines.append(f"  {size / 1024:10.1f} KB  {site}")
+        return "\n".join(lines)
+
+
+@contextmanager
+def profile_memory(output_path=None, top=TOP_ALLOCATIONS):
+    """Trace Python allocations in the block, grouped by pipeline stage.
+
+    Yields a `MemoryProfile`; its report is written to `output_path` if
+    given. Allocations made outside `flatten_pdf` stages are reported
+    under `stats.NO_STAGE`.
+    """
+    profile = MemoryProfile(top)
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        if output_path:
+            with open(output_path, "w") as f:
+                f.write(profile.format() + "\n")
@@ -0,0 +1,311 @@
+"""Local flattening service that keeps warm worker processes around.
+
+Run with ``flatten-pdf serve``. PDFs are POSTed as the request body to
+``/flatten`` over TCP or a Unix domain socket and the flattened PDF is
+returned in the response.
+"""
+
+import os
+import socketserver
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .cli import (
+    BACKEND,
+    DPI,
+    JOBS,
+    RENDERERS,
+    configure_logging,
+    flatten_bytes,
+    logger,
+)
+
+HOST = "127.0.0.1"
+PORT = 8000
+WORKERS = os.cpu_count() or 1
+MAX_REQUEST_MB = 100
+# Seconds a client may stall while sending a request before it is dropped
+REQUEST_TIMEOUT = 30
+
+# Query parameters a client may pass through to flatten_pdf
+REQUEST_OPTIONS = ("creation_date", "modification_date")
+
+
+def warm_up():
+    """Import the rendering libraries so the first request doesn't pay for it."""
+    import fitz  # noqa: F401
+    import pdf2image  # noqa: F401
+    from PIL import Image  # noqa: F401
+
+
+class FlattenService:
+    """Pool of pre-imported workers with a limit on concurrent requests.
+
+    If a worker dies hard (e.g. crashing inside MuPDF on a bad upload), the
+    request it was handling fails and the pool is replaced, so later
+    requests don't inherit the broken pool.
+    """
+
+    def __init__(
+        self,
+        workers=WORKERS,
+        concurrency=None,
+        max_request_bytes=MAX_REQUEST_MB * 1024 * 1024,
+        **options,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self.concurrency = concurrency or workers
+        self.max_request_bytes = max_request_bytes
+        self.options = options
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.lock = threading.Lock()
+        self.executor = self.start_executor()
+
+    def start_executor(self):
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        # Start every worker now instead of on the first requests
+        for future in [executor.submit(warm_up) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def replace_executor(self, broken):
+        """Swap `broken` for a fresh pool unless another request already did."""
+        with self.lock:
+            if self.executor is broken:
+                logger.warning("A worker process died; starting a new worker pool")
+                self.executor = self.start_executor()
+        broken.shutdown(wait=False)
+
+    def try_acquire(self):
+        return self.slots.acquire(blocking=False)
+
+    def release(self):
+        self.slots.release()
+
+    def flatten(self, data, **request_options):
+        options = dict(self.options, **request_options)
+        executor = self.executor
+        try:
+            future = executor.submit(flatten_bytes, data, **options)
+        except BrokenProcessPool:
+            # Broken by an earlier request; this one hasn't run yet
+            self.replace_executor(executor)
+            executor = self.executor
+            future = executor.submit(flatten_bytes, data, **options)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.replace_executor(executor)
+            raise
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class FlattenRequestHandler(BaseHTTPRequestHandler):
+    server_version = "pdf-flattener"
+    service = None
+    timeout = REQUEST_TIMEOUT
+
+    def address_string(self):
+        # Unix domain socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+    def send_text(self, status, message, headers=None):
+        body = f"{message}\n".encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self.send_text(HTTPStatus.OK, "ok")
+        else:
+            self.send_text(HTTPStatus.NOT_FOUND, "Not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/", "/flatten"):
+            self.send_text(HTTPStatus.NOT_FOUND, "Not found")
+            return
+
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_text(HTTPStatus.LENGTH_REQUIRED, "Content-Length required")
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_text(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+            return
+        if length > self.service.max_request_bytes:
+            self.close_connection = True
+            self.send_text(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                f"Request body exceeds {self.service.max_request_bytes} bytes",
+            )
+            return
+
+        query = parse_qs(url.query)
+        request_options = {
+            name: query[name][0] for name in REQUEST_OPTIONS if name in query
+        }
+
+        # Read the body before taking a slot, so a slow client (dropped after
+        # `timeout` seconds of silence) never holds one
+        data = self.rfile.read(length)
+        if len(data) < length:
+            self.close_connection = True
+            self.send_text(HTTPStatus.BAD_REQUEST, "Incomplete request body")
+            return
+
+        if not self.service.try_acquire():
+            self.close_connection = True
+            self.send_text(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                "Too many concurrent requests",
+                {"Retry-After": "1"},
+            )
+            return
+        try:
+            try:
+                result = self.service.flatten(data, **request_options)
+            except Exception as e:
+                logger.error(f"Failed to flatten request: {e}")
+                self.send_text(HTTPStatus.UNPROCESSABLE_ENTITY, f"Failed to flatten PDF: {e}")
+                return
+        finally:
+            self.service.release()
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):  # not available on Windows
+
+    class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+            super().server_bind()
+
+
+def create_server(service, host=HOST, port=PORT, socket_path=None, timeout=REQUEST_TIMEOUT):
+    """Create an HTTP server that hands requests to `service`.
+
+    Connections that send nothing for `timeout` seconds are closed.
+    """
+    handler = type(
+        "Handler", (FlattenRequestHandler,), {"service": service, "timeout": timeout}
+    )
+    if socket_path:
+        if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+            raise ValueError("Unix domain sockets are not supported on this platform")
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def parse_arguments(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="flatten-pdf serve",
+        description="Serve PDF flattening over HTTP on a TCP port or Unix socket.",
+    )
+    parser.add_argument("--host", help=f"Address to listen on (default: {HOST})", default=HOST)
+    parser.add_argument(
+        "--port", "-p", type=int, help=f"Port to listen on (default: {PORT})", default=PORT
+    )
+    parser.add_argument(
+        "--socket", "-s", help="Listen on this Unix domain socket instead of TCP", default=None
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="Number of worker processes (default: number of CPUs)",
+        default=WORKERS,
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Maximum number of requests processed at once (default: --workers)",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-request-mb",
+        type=float,
+        help=f"Largest accepted PDF in MB (default: {MAX_REQUEST_MB})",
+        default=MAX_REQUEST_MB,
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        help=f"Seconds a client may stall while sending a request (default: {REQUEST_TIMEOUT})",
+        default=REQUEST_TIMEOUT,
+    )
+    parser.add_argument(
+        "--dpi", "-d", type=int, help=f"DPI for image extraction (default: {DPI})", default=DPI
+    )
+    parser.add_argument(
+        "--backend",
+        "-b",
+        choices=sorted(RENDERERS),
+        help=f"Rendering backend (default: {BACKEND})",
+        default=BACKEND,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help=f"Number of processes used to render the pages of one request (default: {JOBS})",
+        default=JOBS,
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    configure_logging()
+    args = parse_arguments(argv)
+
+    service = FlattenService(
+        workers=args.workers,
+        concurrency=args.concurrency,
+        max_request_bytes=int(args.max_request_mb * 1024 * 1024),
+        dpi=args.dpi,
+        backend=args.backend,
+        jobs=args.jobs,
+    )
+    server = create_server(service, args.host, args.port, args.socket, args.request_timeout)
+    where = args.socket or f"http://{args.host}:{server.server_address[1]}"
+    print(f"Serving on {where}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
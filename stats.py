@@ -0,0 +1,198 @@
+"""Timing and resource statistics of a single flatten."""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+# Name passed to stage hooks for time spent outside any stage
+NO_STAGE = "other"
+
+# Callables notified as `hook(finished_stage, started_stage)` whenever the
+# running stage changes, e.g. by the memory profiler
+_stage_hooks = []
+
+
+def add_stage_hook(hook):
+    _stage_hooks.append(hook)
+
+
+def remove_stage_hook(hook):
+    _stage_hooks.remove(hook)
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None if unknown."""
+    # The high-water mark in /proc belongs to this process image alone, while
+    # ru_maxrss on Linux includes the RSS of the parent at fork time.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def children_cpu_seconds():
+    """CPU time of finished child processes, such as pdftoppm and render workers."""
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def clock():
+    return time.perf_counter(), time.process_time(), children_cpu_seconds()
+
+
+class FlattenStats:
+    """Where the time and memory of one `flatten_pdf` call went.
+
+    Stages are timed exclusively: while a nested stage runs, the enclosing
+    one is paused, so the stage times add up to the total. `pages` holds one
+    dictionary per rasterized page with its effective DPI, render and encode
+    times, encoded size and JPEG quality; pages read from the page cache have
+    `"cached": True`. `copied_pages` counts pages copied without rendering.
+    On a result cache hit no pages are rendered and `pages` stays empty.
+    """
+
+    def __init__(self, dpi=None):
+        self.dpi = dpi
+        self.stages = {}
+        self.pages = []
+        self.input_bytes = None
+        self.output_bytes = None
+        self.peak_rss_bytes = None
+        self.cache_hit = None
+        self.copied_pages = 0
+        self._stack = []
+
+    def _charge(self, now):
+        name, start = self._stack[-1]
+        stage = self.stages.setdefault(
+            name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "children_cpu_seconds": 0.0}
+        )
+        for key, end, begin in zip(
+            ("wall_seconds", "cpu_seconds", "children_cpu_seconds"), now, start
+        ):
+            stage[key] += end - begin
+
+    def _current(self):
+        return self._stack[-1][0] if self._stack else NO_STAGE
+
+    @contextmanager
+    def measure(self, name):
+        """Add the time spent inside the block to stage `name`."""
+        for hook in _stage_hooks:
+            hook(self._current(), name)
+        now = clock()
+        if self._stack:
+            self._charge(now)
+        self._stack.append((name, now))
+        try:
+            yield
+        finally:
+            now = clock()
+            self._charge(now)
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1] = (self._stack[-1][0], now)
+            for hook in _stage_hooks:
+                hook(name, self._current())
+
+    def timed(self, name, iterable):
+        """Yield from `iterable`, adding the time spent producing items to stage `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.measure(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_page(self, info):
+        self.pages.append(info)
+
+    @property
+    def page_count(self):
+        return len(self.pages)
+
+    @property
+    def downscaled_pages(self):
+        """Page numbers rendered below the requested DPI to fit the pixel budget."""
+        return [
+            page["page"]
+            for page in self.pages
+            if self.dpi is not None and page.get("dpi", self.dpi) < self.dpi
+        ]
+
+    def total(self, key="wall_seconds"):
+        return sum(stage[key] for stage in self.stages.values())
+
+    def to_dict(self):
+        return {
+            "dpi": self.dpi,
+            "pages": self.page_count,
+            "downscaled_pages": self.downscaled_pages,
+            "cached_pages": sum(1 for page in self.pages if page.get("cached")),
+            "copied_pages": self.copied_pages,
+            "cache_hit": self.cache_hit,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "wall_seconds": self.total("wall_seconds"),
+            "cpu_seconds": self.total("cpu_seconds"),
+            "children_cpu_seconds": self.total("children_cpu_seconds"),
+            "stages": self.stages,
+            "page_stats": self.pages,
+        }
+
+    def format(self):
+        """Return a human-readable summary."""
+        lines = [f"Pages: {self.page_count}"]
+        if self.copied_pages:
+            lines[0] += f" rasterized, {self.copied_pages} copied"
+        if self.downscaled_pages:
+            lines.append(
+                f"Rendered below {self.dpi} DPI: pages "
+                f"{', '.join(map(str, self.downscaled_pages))}"
+            )
+        if self.input_bytes is not None and self.output_bytes is not None:
+            lines.append(f"Size: {self.input_bytes} -> {self.output_bytes} bytes")
+        if self.peak_rss_bytes is not None:
+            lines.append(f"Peak RSS: {self.peak_rss_bytes / 1024 / 1024:.1f} MB")
+        lines.append(f"{'Stage':<12} {'wall s':>9} {'cpu s':>9} {'child cpu s':>12}")
+        for name, stage in self.stages.items():
+            lines.append(
+                f"{name:<12} {stage['wall_seconds']:9.3f} {stage['cpu_seconds']:9.3f} "
+                f"{stage['children_cpu_seconds']:12.3f}"
+            )
+        lines.append(
+            f"{'total':<12} {self.total('wall_seconds'):9.3f} {self.total('cpu_seconds'):9.3f} "
+            f"{self.total('children_cpu_seconds'):12.3f}"
+        )
+        qualities = sorted(
+            page["quality"] for page in self.pages if page.get("quality") is not None
+        )
+        if qualities and qualities[0] != qualities[-1]:
+            lines.append(
+                f"JPEG quality: {qualities[0]} to {qualities[-1]}, "
+                f"median {qualities[len(qualities) // 2]}"
+            )
+        rendered = [page for page in self.pages if not page.get("cached")]
+        if rendered:
+            render = sum(page["render_seconds"] for page in rendered)
+            encode = sum(page["encode_seconds"] for page in rendered)
+            lines.append(
+                f"Per page: {render / len(rendered):.3f} s render, "
+                f"{encode / len(rendered):.3f} s encode on average"
+            )
+        return "\n".join(lines)
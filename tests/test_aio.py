@@ -0,0 +1,192 @@
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+import pytest
+
+from pdf_flattener import aio
+
+# Stands in for Poppler's pdftoppm: renders pages with MuPDF to ROOT-NN.ppm
+FAKE_PDFTOPPM = """\
+import sys
+import fitz
+
+args = sys.argv[1:]
+dpi, first, last = (int(args[args.index(flag) + 1]) for flag in ("-r", "-f", "-l"))
+gray = "-gray" in args
+doc = fitz.open(args[-2])
+for number in range(first, last + 1):
+    pix = doc[number - 1].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if gray else fitz.csRGB)
+    pix.save(f"{args[-1]}-{number:02d}.{'pgm' if gray else 'ppm'}")
+"""
+
+# Records how many rendered pages wait in the work directory, then renders
+COUNTING_PDFTOPPM = """\
+import os
+import sys
+
+workdir = os.path.dirname(os.path.dirname(sys.argv[-1]))
+waiting = sum(len(files) for _, _, files in os.walk(workdir)) - 1
+with open(os.path.join(os.path.dirname(workdir), "waiting"), "a") as f:
+    f.write(f"{waiting}\\n")
+""" + FAKE_PDFTOPPM
+
+encode_rendered_files = aio.encode_rendered_files
+
+
+def slow_encode_rendered_files(*args):
+    time.sleep(0.3)
+    return encode_rendered_files(*args)
+
+
+def crash_render_page_range(*args):
+    os._exit(1)
+
+
+@pytest.fixture
+def pdf_bytes():
+    """Create a 10-page PDF in memory."""
+    doc = fitz.open()
+    for number in range(10):
+        page = doc.new_page()
+        page.insert_text((100, 100), f"Page {number + 1}")
+    data = doc.write()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def pool():
+    yield
+    aio.shutdown()
+    aio.set_concurrency(aio.CONCURRENCY)
+
+
+def install_pdftoppm(monkeypatch, tmp_path, source):
+    if os.name != "posix":
+        pytest.skip("needs an executable script")
+    script = tmp_path / "pdftoppm"
+    script.write_text(f"#!{sys.executable}\n{source}")
+    script.chmod(0o755)
+    monkeypatch.setattr(aio, "pdftoppm_executable", lambda: str(script))
+
+
+def test_flatten_pdf_async_concurrent(pdf_bytes, tmp_path, pool):
+    """Test that concurrent flattens all complete within the concurrency limit."""
+    aio.set_concurrency(2)
+
+    async def run():
+        return await asyncio.gather(*(
+            aio.flatten_bytes_async(pdf_bytes, dpi=72, backend="mupdf") for _ in range(4)
+        ))
+
+    for data in asyncio.run(run()):
+        doc = fitz.open(stream=data, filetype="pdf")
+        assert doc.page_count == 10
+        assert not doc[0].get_text().strip()
+        doc.close()
+
+    output_path = str(tmp_path / "output.pdf")
+    stats = asyncio.run(aio.flatten_pdf_async(
+        pdf_bytes, output_path, creation_date="2024-01-01", dpi=72, backend="mupdf"
+    ))
+    assert stats.page_count == 10
+    assert stats.output_bytes == os.path.getsize(output_path)
+    with fitz.open(output_path) as doc:
+        assert doc.metadata["creationDate"].startswith("D:20240101")
+
+
+def test_flatten_pdf_async_poppler(pdf_bytes, tmp_path, monkeypatch, pool):
+    """Test the Poppler backend, with pdftoppm run as an asyncio subprocess."""
+    install_pdftoppm(monkeypatch, tmp_path, FAKE_PDFTOPPM)
+    monkeypatch.setattr(aio, "PAGES_PER_JOB", 4)
+
+    output_path = str(tmp_path / "output.pdf")
+    stats = asyncio.run(aio.flatten_pdf_async(
+        pdf_bytes, output_path, dpi=72, backend="poppler", grayscale="force"
+    ))
+    assert [page["page"] for page in stats.pages] == list(range(1, 11))
+    with fitz.open(output_path) as doc:
+        assert doc.page_count == 10
+        assert doc[0].get_images(full=True)[0][5] == "DeviceGray"
+
+
+def test_poppler_batches_in_flight_are_bounded(pdf_bytes, tmp_path, monkeypatch, pool):
+    """Test that rendered pages don't pile up while workers encode slowly."""
+    install_pdftoppm(monkeypatch, tmp_path, COUNTING_PDFTOPPM)
+    monkeypatch.setattr(aio, "PAGES_PER_JOB", 2)
+    # Workers are forked after this, so they encode slowly too
+    monkeypatch.setattr(aio, "encode_rendered_files", slow_encode_rendered_files)
+    monkeypatch.setattr(aio.tempfile, "tempdir", str(tmp_path))
+    aio.set_concurrency(1)
+
+    data = asyncio.run(aio.flatten_bytes_async(pdf_bytes, dpi=72, backend="poppler"))
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        assert doc.page_count == 10
+    # Two batches of two pages at most: the one being encoded and the next
+    waiting = [int(line) for line in (tmp_path / "waiting").read_text().split()]
+    assert len(waiting) == 5
+    assert max(waiting) <= 4
+
+
+def test_cancel_kills_pdftoppm(pdf_bytes, tmp_path, monkeypatch, pool):
+    """Test that cancelling a flatten kills the running pdftoppm."""
+    pid_path = tmp_path / "pid"
+    install_pdftoppm(monkeypatch, tmp_path, (
+        "import os, time\n"
+        f"open({str(pid_path)!r}, 'w').write(str(os.getpid()))\n"
+        "time.sleep(60)\n"
+    ))
+
+    async def run():
+        task = asyncio.create_task(
+            aio.flatten_pdf_async(pdf_bytes, str(tmp_path / "output.pdf"), backend="poppler")
+        )
+        while not pid_path.exists() or not pid_path.read_text():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The slot is free again
+        assert not aio.get_limit().locked()
+
+    asyncio.run(asyncio.wait_for(run(), 30))
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+    assert not (tmp_path / "output.pdf").exists()
+
+
+def test_set_concurrency_during_flatten(pdf_bytes, monkeypatch, pool):
+    """Test that a running flatten keeps its worker pool when the limit changes."""
+    plan_page_dpis = aio.plan_page_dpis
+
+    def plan_and_change_limit(*args):
+        aio.set_concurrency(1)
+        return plan_page_dpis(*args)
+
+    monkeypatch.setattr(aio, "plan_page_dpis", plan_and_change_limit)
+    data = asyncio.run(aio.flatten_bytes_async(pdf_bytes, dpi=72, backend="mupdf"))
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        assert doc.page_count == 10
+
+
+def test_worker_crash_replaces_pool(pdf_bytes, monkeypatch, pool):
+    """Test that flattens work again after a worker process died."""
+    with monkeypatch.context() as patch:
+        # Workers are forked after this, so they crash too
+        patch.setattr(aio, "render_page_range", crash_render_page_range)
+        with pytest.raises(BrokenProcessPool):
+            asyncio.run(aio.flatten_bytes_async(pdf_bytes, dpi=72, backend="mupdf"))
+
+    data = asyncio.run(aio.flatten_bytes_async(pdf_bytes, dpi=72, backend="mupdf"))
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        assert doc.page_count == 10
+
+
+def test_set_concurrency_invalid():
+    """Test that the concurrency limit must be positive."""
+    with pytest.raises(ValueError):
+        aio.set_concurrency(0)
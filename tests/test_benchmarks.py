@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from pdf_flattener.benchmarks.corpus import generate_corpus, generate_document
+from pdf_flattener.benchmarks.run import main, run_benchmarks
+
+
+def test_run_benchmarks_reports_each_stage():
+    """Test that every requested stage is measured on a generated document."""
+    report = run_benchmarks(
+        profiles=("text",), stages=("compress_pdf", "flatten_pdf"), repeat=1, pages=1
+    )
+    assert report["environment"]["pymupdf"]
+    assert [result["stage"] for result in report["results"]] == ["compress_pdf", "flatten_pdf"]
+    for result in report["results"]:
+        assert result["profile"] == "text"
+        assert result["pages"] == 1
+        assert result["pages_per_second"] > 0
+        assert result["bytes_per_page"] > 0
+
+
+def test_run_benchmarks_rejects_unknown_names():
+    """Test that unknown profiles and stages are rejected."""
+    with pytest.raises(ValueError):
+        run_benchmarks(profiles=("nonexistent",), repeat=1, pages=1)
+    with pytest.raises(ValueError):
+        run_benchmarks(stages=("nonexistent",), repeat=1, pages=1)
+
+
+def test_main_writes_json(tmp_path):
+    """Test that the command line entry point writes machine-readable results."""
+    output = tmp_path / "results.json"
+    main(["--profile", "text", "--stage", "set_metadata", "-r", "1", "--pages", "1",
+          "-o", str(output)])
+    report = json.loads(output.read_text())
+    assert [result["stage"] for result in report["results"]] == ["set_metadata"]
+
+
+def test_generate_document_is_deterministic(tmp_path):
+    """Test that a seed always produces the same bytes and features."""
+    import fitz
+
+    options = dict(pages=2, drawings=20, photos=1, form_fields=3, annotations=3)
+    first, second, other = (str(tmp_path / name) for name in ("a.pdf", "b.pdf", "c.pdf"))
+    generate_document(first, seed=1, **options)
+    generate_document(second, seed=1, **options)
+    generate_document(other, seed=2, **options)
+    with open(first, "rb") as f, open(second, "rb") as g, open(other, "rb") as h:
+        first_bytes = f.read()
+        assert first_bytes == g.read()
+        assert first_bytes != h.read()
+
+    doc = fitz.open(first)
+    assert doc.page_count == 2
+    page = doc[0]
+    assert len(list(page.widgets())) == 3
+    assert len(list(page.annots())) == 3
+    assert page.get_images()
+    assert page.get_text()
+    doc.close()
+
+
+def test_generate_corpus(tmp_path):
+    """Test that a named corpus is written to the requested directory."""
+    paths = generate_corpus("small", str(tmp_path / "corpus"))
+    assert paths and all(os.path.exists(path) for path in paths)
+    with pytest.raises(ValueError):
+        generate_corpus("nonexistent", str(tmp_path))
@@ -0,0 +1,216 @@
+import os
+import time
+
+import fitz
+import pytest
+
+import pdf_flattener.cli as cli
+from pdf_flattener.cache import (
+    CacheMiss,
+    Checkpoint,
+    PageCache,
+    ResultCache,
+    page_fingerprints,
+)
+
+
+@pytest.fixture
+def sample_pdf(tmp_path):
+    """Create a one-page PDF."""
+    pdf_path = tmp_path / "test.pdf"
+    doc = fitz.open()
+    doc.new_page().insert_text((100, 100), "Test PDF")
+    doc.save(str(pdf_path))
+    doc.close()
+    return str(pdf_path)
+
+
+def test_cache_key_depends_on_input_and_options(sample_pdf, tmp_path):
+    """Test that the key changes with the input bytes and with the options."""
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = cache.key(sample_pdf, dpi=200, backend="mupdf")
+    assert key == cache.key(sample_pdf, backend="mupdf", dpi=200)
+    assert key != cache.key(sample_pdf, dpi=300, backend="mupdf")
+
+    with open(sample_pdf, "ab") as f:
+        f.write(b"\n")
+    assert key != cache.key(sample_pdf, dpi=200, backend="mupdf")
+
+
+def test_cache_miss(tmp_path):
+    """Test that fetching a missing entry raises CacheMiss."""
+    cache = ResultCache(str(tmp_path / "cache"))
+    with pytest.raises(CacheMiss):
+        cache.fetch("0" * 64, str(tmp_path / "out.pdf"))
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """Test that the oldest entries are dropped once the cache is full."""
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=2500)
+    source = tmp_path / "source.pdf"
+    source.write_bytes(b"x" * 1000)
+
+    for key in ("a" * 64, "b" * 64):
+        cache.store(key, str(source))
+        time.sleep(0.01)
+    # Reading "a" makes "b" the least recently used entry
+    cache.fetch("a" * 64, str(tmp_path / "out.pdf"))
+    time.sleep(0.01)
+    cache.store("c" * 64, str(source))
+
+    assert os.path.exists(cache.path("a" * 64))
+    assert not os.path.exists(cache.path("b" * 64))
+    assert os.path.exists(cache.path("c" * 64))
+
+
+def test_flatten_pdf_cache_hit(sample_pdf, tmp_path, monkeypatch):
+    """Test that a cache hit skips rendering but still applies the dates."""
+    cache_dir = str(tmp_path / "cache")
+    first = str(tmp_path / "first.pdf")
+    cli.flatten_pdf(sample_pdf, first, dpi=72, backend="mupdf", cache_dir=cache_dir)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("pages were rendered despite a cache hit")
+
+    monkeypatch.setattr(cli, "iter_encoded_pages", fail)
+    second = str(tmp_path / "second.pdf")
+    cli.flatten_pdf(
+        sample_pdf,
+        second,
+        creation_date="2024-01-01",
+        modification_date="2024-01-02",
+        dpi=72,
+        backend="mupdf",
+        cache_dir=cache_dir,
+    )
+
+    doc = fitz.open(second)
+    assert doc.page_count == 1
+    assert doc.metadata["creationDate"].startswith("D:20240101")
+    doc.close()
+    assert time.localtime(os.path.getmtime(second))[:3] == (2024, 1, 2)
+
+    with pytest.raises(AssertionError):
+        cli.flatten_pdf(sample_pdf, second, dpi=100, backend="mupdf", cache_dir=cache_dir)
+
+
+def make_pdf(path, texts):
+    doc = fitz.open()
+    for text in texts:
+        doc.new_page().insert_text((100, 100), text)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def test_page_fingerprints_match_across_documents(tmp_path):
+    """Test that identical pages hash alike regardless of their document."""
+    first = make_pdf(tmp_path / "first.pdf", ["Terms", "Cover"])
+    second = make_pdf(tmp_path / "second.pdf", ["Other", "Terms"])
+
+    first_prints = page_fingerprints(first)
+    second_prints = page_fingerprints(second)
+    assert first_prints[0] == second_prints[1]
+    assert first_prints[0] != first_prints[1]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_page_cache_reuses_pages(tmp_path, jobs):
+    """Test that pages seen in one document are not rendered again in another."""
+    page_cache = PageCache(str(tmp_path / "pages"))
+    first = make_pdf(tmp_path / "first.pdf", ["Terms", "Cover"])
+    second = make_pdf(tmp_path / "second.pdf", ["Terms", "Exhibit", "Cover"])
+
+    cli.flatten_pdf(
+        first, str(tmp_path / "a.pdf"), dpi=72, backend="mupdf", jobs=jobs, page_cache=page_cache
+    )
+    assert (page_cache.hits, page_cache.misses) == (0, 2)
+
+    output = str(tmp_path / "b.pdf")
+    cli.flatten_pdf(
+        second, output, dpi=72, backend="mupdf", jobs=jobs, page_cache=page_cache
+    )
+    assert (page_cache.hits, page_cache.misses) == (2, 3)
+
+    doc = fitz.open(output)
+    assert doc.page_count == 3
+    doc.close()
+
+
+def test_checkpoint_resumes_interrupted_flatten(tmp_path, monkeypatch):
+    """Test that a flatten interrupted halfway renders only the missing pages when rerun."""
+    pdf_path = make_pdf(tmp_path / "input.pdf", [f"Page {number}" for number in range(1, 11)])
+    work_dir = str(tmp_path / "work")
+    output = str(tmp_path / "output.pdf")
+    encode_page = cli.encode_page
+    encoded = []
+    crash_after = [6]
+
+    def encode_or_crash(image, *args, **kwargs):
+        if len(encoded) == crash_after[0]:
+            raise RuntimeError("preempted")
+        encoded.append(image)
+        return encode_page(image, *args, **kwargs)
+
+    monkeypatch.setattr(cli, "encode_page", encode_or_crash)
+    with pytest.raises(RuntimeError):
+        cli.flatten_pdf(pdf_path, output, dpi=72, backend="mupdf", work_dir=work_dir)
+    assert not os.path.exists(output)
+    assert len([name for name in os.listdir(work_dir) if name.endswith(".page")]) == 6
+
+    encoded.clear()
+    crash_after[0] = None
+    stats = cli.flatten_pdf(pdf_path, output, dpi=72, backend="mupdf", work_dir=work_dir)
+    assert len(encoded) == 4
+    assert sum(1 for page in stats.pages if page.get("cached")) == 6
+    assert os.listdir(work_dir) == []
+
+    doc = fitz.open(output)
+    assert doc.page_count == 10
+    doc.close()
+
+
+def test_checkpoint_resumes_with_max_output(tmp_path, monkeypatch):
+    """Test resuming a size-limited flatten, whose options include a tuple of qualities."""
+    pdf_path = make_pdf(tmp_path / "input.pdf", [f"Page {number}" for number in range(1, 6)])
+    work_dir = str(tmp_path / "work")
+    output = str(tmp_path / "output.pdf")
+    encode_page_ladder = cli.encode_page_ladder
+    encoded = []
+    crash_after = [3]
+
+    def encode_or_crash(image, *args, **kwargs):
+        if len(encoded) == crash_after[0]:
+            raise RuntimeError("preempted")
+        encoded.append(image)
+        return encode_page_ladder(image, *args, **kwargs)
+
+    monkeypatch.setattr(cli, "encode_page_ladder", encode_or_crash)
+    options = {"dpi": 72, "backend": "mupdf", "work_dir": work_dir, "max_output_mb": 1}
+    with pytest.raises(RuntimeError):
+        cli.flatten_pdf(pdf_path, output, **options)
+    assert len([name for name in os.listdir(work_dir) if name.endswith(".page")]) == 3
+
+    encoded.clear()
+    crash_after[0] = None
+    stats = cli.flatten_pdf(pdf_path, output, **options)
+    assert len(encoded) == 2
+    assert sum(1 for page in stats.pages if page.get("cached")) == 3
+
+    doc = fitz.open(output)
+    assert doc.page_count == 5
+    doc.close()
+
+
+def test_checkpoint_discarded_when_options_change(tmp_path):
+    """Test that pages checkpointed with other options are not reused."""
+    pdf_path = make_pdf(tmp_path / "input.pdf", ["One", "Two"])
+    checkpoint = Checkpoint(str(tmp_path / "work"))
+    keys = checkpoint.keys(pdf_path, dpi=72)
+    checkpoint.put(keys[0], b"page")
+    assert keys[0] in checkpoint
+
+    assert checkpoint.keys(pdf_path, dpi=72) == keys
+    assert keys[0] in checkpoint
+    checkpoint.keys(pdf_path, dpi=100)
+    assert keys[0] not in checkpoint
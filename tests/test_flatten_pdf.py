@@ -1,3 +1,5 @@
+import io
+import sys
 import os
 import pytest
 import tempfile
@@ -9,11 +11,25 @@ from pathlib import Path
 from flatten_pdf import (
     get_poppler_path,
     extract_images_from_pdf,
+    iter_images_from_pdf,
+    iter_encoded_pages,
     create_pdf_from_images,
     compress_pdf,
     set_metadata,
     flatten_pdf,
-    safe_temp_file
+    safe_temp_file,
+    collect_input_paths,
+    flatten_many,
+    main,
+    effective_dpi,
+    get_pixel_budget,
+    encode_image,
+    is_bilevel,
+    is_grayscale,
+    parse_page_range,
+    select_pages,
+    encode_jpeg_to_size,
+    allocate_qualities,
 )
 
 def safe_remove_file(file_path, max_retries=3, delay=0.1):
@@ -106,6 +122,33 @@ def test_extract_images_from_pdf(sample_pdf):
     assert len(images) > 0
     assert all(hasattr(img, 'save') for img in images)
 
+def test_iter_images_from_pdf_is_lazy(sample_pdf, output_path):
+    """Test that pages are streamed rather than returned as a list."""
+    images = iter_images_from_pdf(sample_pdf, batch_size=1)
+    assert not isinstance(images, list)
+    create_pdf_from_images(images, output_path)
+
+    import fitz
+    doc = fitz.open(output_path)
+    assert doc.page_count == 1
+    doc.close()
+
+def test_iter_images_from_pdf_nonexistent():
+    """Test that a missing input is reported before iteration starts."""
+    with pytest.raises(FileNotFoundError):
+        iter_images_from_pdf("nonexistent.pdf")
+
+def test_extract_images_from_pdf_mupdf(sample_pdf):
+    """Test rendering with the in-process MuPDF backend."""
+    images = extract_images_from_pdf(sample_pdf, dpi=72, backend="mupdf")
+    assert len(images) == 1
+    assert images[0].size == (595, 842)  # A4 at 72 DPI
+
+def test_extract_images_from_pdf_unknown_backend(sample_pdf):
+    """Test that an unknown backend is rejected."""
+    with pytest.raises(ValueError):
+        extract_images_from_pdf(sample_pdf, backend="nonexistent")
+
 def test_extract_images_from_pdf_nonexistent():
     """Test error handling for nonexistent PDF."""
     with pytest.raises(FileNotFoundError):
@@ -119,6 +162,56 @@ def test_create_pdf_from_images(sample_pdf, output_path):
     assert os.path.getsize(output_path) > 0
     safe_remove_file(output_path)
 
+@pytest.fixture
+def multipage_pdf(tmp_path):
+    """Create a PDF whose pages can be told apart by size."""
+    import fitz
+
+    pdf_path = tmp_path / "multipage.pdf"
+    doc = fitz.open()
+    for i in range(20):
+        page = doc.new_page(width=100 + i, height=200)
+        page.insert_text((10, 50), f"Page {i + 1}")
+    doc.save(str(pdf_path))
+    doc.close()
+    yield str(pdf_path)
+
+def test_iter_encoded_pages_parallel_order(multipage_pdf):
+    """Test that pages rendered on several processes come back in order."""
+    import fitz
+
+    pages = list(iter_encoded_pages(multipage_pdf, dpi=72, backend="mupdf", jobs=3))
+    assert len(pages) == 20
+    widths = [fitz.Pixmap(data).width for data in pages]
+    assert widths == [100 + i for i in range(20)]
+
+def test_flatten_pdf_parallel(multipage_pdf, output_path):
+    """Test flatten_pdf with several render processes."""
+    import fitz
+
+    flatten_pdf(multipage_pdf, output_path, dpi=72, backend="mupdf", jobs=2)
+    doc = fitz.open(output_path)
+    assert doc.page_count == 20
+    assert [int(page.rect.width) for page in doc] == [100 + i for i in range(20)]
+    doc.close()
+
+def test_flatten_pdf_invalid_jobs(sample_pdf, output_path):
+    """Test that jobs must be positive."""
+    with pytest.raises(ValueError):
+        flatten_pdf(sample_pdf, output_path, jobs=0)
+
+def test_create_pdf_from_images_keeps_jpeg_stream(sample_pdf, output_path):
+    """Test that pages are stored as DCT streams rather than raw samples."""
+    import fitz
+
+    images = extract_images_from_pdf(sample_pdf, dpi=72, backend="mupdf")
+    create_pdf_from_images(images, output_path)
+
+    doc = fitz.open(output_path)
+    xref = doc[0].get_images()[0][0]
+    assert doc.xref_get_key(xref, "Filter") == ("name", "/DCTDecode")
+    doc.close()
+
 def test_compress_pdf(sample_pdf, output_path):
     """Test PDF compression functionality."""
     compress_pdf(sample_pdf, output_path)
@@ -155,6 +248,12 @@ def test_flatten_pdf(sample_pdf, output_path):
     safe_remove_file(output_path)
     safe_remove_file(sample_pdf)
 
+def test_flatten_pdf_mupdf_backend(sample_pdf, output_path):
+    """Test flatten_pdf without Poppler."""
+    flatten_pdf(sample_pdf, output_path, backend="mupdf")
+    assert os.path.exists(output_path)
+    assert os.path.getsize(output_path) > 0
+
 def test_flatten_pdf_with_dates(sample_pdf, output_path):
     """Test flatten_pdf with custom dates."""
     creation_date = "2024-01-01"
@@ -173,6 +272,23 @@ def test_flatten_pdf_with_dates(sample_pdf, output_path):
     safe_remove_file(output_path)
     safe_remove_file(sample_pdf)
 
+def test_flatten_pdf_single_write(sample_pdf, tmp_path):
+    """Test that the output is written in place with its metadata and no leftovers."""
+    import fitz
+
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    output = output_dir / "flat.pdf"
+    flatten_pdf(sample_pdf, str(output), "2024-01-01", "2024-01-02", backend="mupdf")
+
+    assert os.listdir(output_dir) == ["flat.pdf"]
+    doc = fitz.open(str(output))
+    assert doc.metadata["creationDate"].startswith("D:20240101")
+    assert doc.metadata["modDate"].startswith("D:20240102")
+    doc.close()
+    # A single full save leaves no incremental update sections behind
+    assert output.read_bytes().count(b"%%EOF") == 1
+
 def test_flatten_pdf_nonexistent_input():
     """Test flatten_pdf with nonexistent input file."""
     with pytest.raises(FileNotFoundError):
@@ -191,4 +307,436 @@ def test_flatten_pdf_existing_output(sample_pdf, output_path):
     
     # Cleanup
     safe_remove_file(output_path)
-    safe_remove_file(sample_pdf) 
\ No newline at end of file
+    safe_remove_file(sample_pdf) 
+@pytest.fixture
+def pdf_tree(tmp_path, sample_pdf):
+    """Create a directory tree of PDFs plus one file that is not a PDF."""
+    root = tmp_path / "inbox"
+    (root / "sub").mkdir(parents=True)
+    shutil.copy(sample_pdf, root / "a.pdf")
+    shutil.copy(sample_pdf, root / "sub" / "b.PDF")
+    (root / "notes.txt").write_text("not a pdf")
+    yield root
+
+def test_collect_input_paths(pdf_tree):
+    """Test expansion of directories and glob patterns."""
+    found = collect_input_paths([str(pdf_tree)])
+    assert [rel for _, rel in found] == ["a.pdf", os.path.join("sub", "b.PDF")]
+
+    found = collect_input_paths([str(pdf_tree / "*.pdf"), str(pdf_tree / "a.pdf")])
+    assert [rel for _, rel in found] == ["a.pdf"]
+
+    # Glob matches keep the folders below the pattern's fixed prefix
+    found = collect_input_paths([str(pdf_tree / "*" / "*.PDF")])
+    assert [rel for _, rel in found] == [os.path.join("sub", "b.PDF")]
+
+def test_flatten_many_reports_failures(pdf_tree, tmp_path):
+    """Test that one bad file doesn't stop the rest of a batch."""
+    bad_pdf = pdf_tree / "bad.pdf"
+    bad_pdf.write_bytes(b"not a pdf")
+    files = [
+        (str(pdf_tree / "a.pdf"), str(tmp_path / "flat-a.pdf")),
+        (str(bad_pdf), str(tmp_path / "flat-bad.pdf")),
+        (str(pdf_tree / "sub" / "b.PDF"), str(tmp_path / "flat-b.pdf")),
+    ]
+
+    results = list(flatten_many(files, workers=2, dpi=72, backend="mupdf"))
+    errors = {pdf_path: error for pdf_path, _, error in results}
+    assert len(results) == 3
+    assert errors[str(bad_pdf)] is not None
+    assert errors[str(pdf_tree / "a.pdf")] is None
+    assert os.path.exists(tmp_path / "flat-b.pdf")
+
+def test_main_batch_output_dir(pdf_tree, tmp_path, capsys):
+    """Test batch mode on the command line."""
+    output_dir = tmp_path / "flat"
+    with pytest.raises(SystemExit) as excinfo:
+        main([str(pdf_tree), "-O", str(output_dir), "-b", "mupdf", "-d", "72"])
+    assert excinfo.value.code == 0
+    assert os.path.exists(output_dir / "flat-a.pdf")
+    assert os.path.exists(output_dir / "sub" / "flat-b.PDF")
+    assert "2 succeeded, 0 failed." in capsys.readouterr().out
+
+def test_main_batch_same_names(pdf_tree, tmp_path, capsys):
+    """Test that inputs with the same name in different folders don't overwrite each other."""
+    for name in ("one", "two"):
+        (pdf_tree / name).mkdir()
+        shutil.copy(pdf_tree / "a.pdf", pdf_tree / name / "exhibit.pdf")
+    output_dir = tmp_path / "flat"
+
+    with pytest.raises(SystemExit) as excinfo:
+        main([str(pdf_tree / "*" / "exhibit.pdf"), "-O", str(output_dir), "-b", "mupdf",
+              "-d", "72"])
+    assert excinfo.value.code == 0
+    assert os.path.exists(output_dir / "one" / "flat-exhibit.pdf")
+    assert os.path.exists(output_dir / "two" / "flat-exhibit.pdf")
+
+    # Explicit files only keep their names, so the second one is reported, not written
+    with pytest.raises(SystemExit) as excinfo:
+        main([str(pdf_tree / "one" / "exhibit.pdf"), str(pdf_tree / "two" / "exhibit.pdf"),
+              "-O", str(tmp_path / "files"), "-b", "mupdf", "-d", "72"])
+    assert excinfo.value.code == 1
+    out = capsys.readouterr().out
+    assert f"FAILED {pdf_tree / 'two' / 'exhibit.pdf'}" in out
+    assert "1 succeeded, 1 failed." in out
+
+def test_effective_dpi():
+    """Test that only pages over the pixel budget get a lower DPI."""
+    assert effective_dpi(612, 792, 200, max_pixels=10_000_000) == 200
+    assert effective_dpi(612, 792, 200, max_pixels=None) == 200
+
+    dpi = effective_dpi(14400, 14400, 200, max_pixels=1_000_000)
+    assert dpi < 200
+    assert (14400 * dpi / 72) ** 2 <= 1_000_000
+
+def test_get_pixel_budget():
+    """Test combining the pixel and memory budgets."""
+    assert get_pixel_budget(1_000_000) == 1_000_000
+    assert get_pixel_budget(None, max_memory_mb=3) == 1024 * 1024
+    assert get_pixel_budget(10_000_000, max_memory_mb=3) == 1024 * 1024
+    assert get_pixel_budget(None) is None
+
+def test_flatten_pdf_oversized_page(tmp_path, output_path, caplog):
+    """Test that a huge page is rendered at a lower DPI with a warning, keeping its size."""
+    import fitz
+
+    pdf_path = str(tmp_path / "poster.pdf")
+    doc = fitz.open()
+    doc.new_page(width=7200, height=7200).insert_text((100, 100), "Poster")
+    doc.new_page(width=72, height=72)
+    doc.save(pdf_path)
+    doc.close()
+
+    stats = flatten_pdf(pdf_path, output_path, dpi=200, backend="mupdf", max_pixels=250_000)
+
+    doc = fitz.open(output_path)
+    # Only the raster gets coarser; the pages stay proportional to each other
+    assert doc[0].rect == fitz.Rect(0, 0, 7200, 7200)
+    assert doc[1].rect == fitz.Rect(0, 0, 72, 72)
+    poster = doc.extract_image(doc[0].get_images()[0][0])
+    assert poster["width"] * poster["height"] <= 250_000
+    assert doc.extract_image(doc[1].get_images()[0][0])["width"] == 200
+    doc.close()
+    assert "exceeds the pixel budget" in caplog.text
+    assert stats.downscaled_pages == [1]
+    assert stats.pages[0]["dpi"] < 200
+    assert stats.pages[1]["dpi"] == 200
+
+def test_is_bilevel():
+    """Test bilevel detection on text-like, gray and colored pages."""
+    from PIL import Image, ImageDraw
+
+    page = Image.new("RGB", (200, 200), "white")
+    ImageDraw.Draw(page).text((10, 10), "Black text", fill="black")
+    assert is_bilevel(page)
+    assert not is_bilevel(Image.new("RGB", (200, 200), (128, 128, 128)))
+    assert not is_bilevel(Image.new("RGB", (200, 200), (255, 255, 0)))
+
+def test_is_bilevel_light_gray():
+    """Test that light-gray fills and watermarks, which thresholding erases, are kept."""
+    import fitz
+    from flatten_pdf import flatten_bytes
+
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 100), "Black text on the page", fontsize=12)
+    page.insert_text((100, 600), "WATERMARK", fontsize=60, color=(0.8, 0.8, 0.8))
+    page = doc.new_page()
+    page.insert_text((72, 100), "Black text on the page", fontsize=12)
+    page.draw_rect(fitz.Rect(72, 200, 500, 400), color=None, fill=(0.85, 0.85, 0.85))
+    output = fitz.open(stream=flatten_bytes(doc.write(), backend="mupdf", bilevel="auto"))
+    doc.close()
+
+    for page in output:
+        xref = page.get_images()[0][0]
+        assert output.xref_get_key(xref, "Filter") == ("name", "/DCTDecode")
+        # The light gray is still there
+        pix = page.get_pixmap(dpi=72, colorspace=fitz.csGRAY)
+        assert any(180 < value < 240 for value in pix.samples)
+    output.close()
+
+def test_flatten_pdf_bilevel(sample_pdf, tmp_path):
+    """Test that text-only pages are stored as CCITT G4 images."""
+    import fitz
+
+    color_output = str(tmp_path / "color.pdf")
+    bilevel_output = str(tmp_path / "bilevel.pdf")
+    flatten_pdf(sample_pdf, color_output, backend="mupdf")
+    flatten_pdf(sample_pdf, bilevel_output, backend="mupdf", bilevel="auto")
+
+    doc = fitz.open(bilevel_output)
+    xref = doc[0].get_images()[0][0]
+    assert doc.xref_get_key(xref, "Filter") == ("name", "/CCITTFaxDecode")
+    assert doc.xref_get_key(xref, "BitsPerComponent") == ("int", "1")
+    # The text survives thresholding and the page stays white
+    pix = doc[0].get_pixmap(dpi=200)
+    assert min(pix.samples) == 0
+    assert pix.pixel(1, 1) == (255, 255, 255)
+    doc.close()
+
+    assert os.path.getsize(bilevel_output) < os.path.getsize(color_output)
+
+def test_encode_image_invalid_bilevel():
+    """Test that an unknown bilevel mode is rejected."""
+    from PIL import Image
+
+    with pytest.raises(ValueError):
+        encode_image(Image.new("RGB", (10, 10)), bilevel="sometimes")
+
+def test_is_grayscale():
+    """Test grayscale detection on gray, lightly tinted and colored pages."""
+    from PIL import Image, ImageDraw
+
+    page = Image.new("RGB", (200, 200), (250, 248, 246))
+    ImageDraw.Draw(page).rectangle((20, 20, 180, 100), fill=(90, 90, 90))
+    assert is_grayscale(page)
+    assert is_grayscale(page.convert("L"))
+    ImageDraw.Draw(page).rectangle((20, 120, 60, 160), fill=(200, 30, 30))
+    assert not is_grayscale(page)
+
+def test_flatten_pdf_grayscale(sample_pdf, tmp_path):
+    """Test that pages without color are stored as single-channel JPEGs."""
+    import fitz
+
+    for mode in ("auto", "force"):
+        output = str(tmp_path / f"{mode}.pdf")
+        flatten_pdf(sample_pdf, output, backend="mupdf", grayscale=mode)
+        doc = fitz.open(output)
+        xref = doc[0].get_images()[0][0]
+        assert doc.xref_get_key(xref, "Filter") == ("name", "/DCTDecode")
+        assert doc.xref_get_key(xref, "ColorSpace") == ("name", "/DeviceGray")
+        doc.close()
+
+def test_encode_image_grayscale_keeps_color():
+    """Test that colored pages stay RGB in auto mode."""
+    from PIL import Image
+
+    data = encode_image(Image.new("RGB", (50, 50), (255, 0, 0)), grayscale="auto")
+    assert Image.open(io.BytesIO(data)).mode == "RGB"
+    with pytest.raises(ValueError):
+        encode_image(Image.new("RGB", (10, 10)), grayscale="sometimes")
+
+def test_flatten_pdf_bands(sample_pdf, tmp_path):
+    """Test that banded rendering produces the same page as a whole-page render."""
+    import fitz
+
+    whole_output = str(tmp_path / "whole.pdf")
+    banded_output = str(tmp_path / "banded.pdf")
+    flatten_pdf(sample_pdf, whole_output, dpi=72, backend="mupdf")
+    flatten_pdf(sample_pdf, banded_output, dpi=72, backend="mupdf", band_pixels=50_000)
+
+    whole = fitz.open(whole_output)
+    banded = fitz.open(banded_output)
+    assert banded[0].rect == whole[0].rect
+    assert len(banded[0].get_images()) > 1
+    # Bands are placed without gaps or overlaps
+    assert sum(rect.height for rect in (
+        banded[0].get_image_rects(image[0])[0] for image in banded[0].get_images()
+    )) == banded[0].rect.height
+    whole_pix = whole[0].get_pixmap(dpi=72)
+    banded_pix = banded[0].get_pixmap(dpi=72)
+    difference = sum(abs(a - b) for a, b in zip(whole_pix.samples, banded_pix.samples))
+    assert difference / len(whole_pix.samples) < 1
+    whole.close()
+    banded.close()
+
+def test_flatten_pdf_stats(multipage_pdf, output_path):
+    """Test that flatten_pdf reports per-stage and per-page statistics."""
+    stats = flatten_pdf(multipage_pdf, output_path, dpi=72, backend="mupdf")
+
+    assert stats.page_count == 20
+    assert [page["page"] for page in stats.pages] == list(range(1, 21))
+    assert all(page["render_seconds"] >= 0 and page["bytes"] > 0 for page in stats.pages)
+    assert {"prepare", "render", "assemble", "save"} <= set(stats.stages)
+    assert stats.total() == pytest.approx(
+        sum(stage["wall_seconds"] for stage in stats.stages.values())
+    )
+    assert stats.input_bytes == os.path.getsize(multipage_pdf)
+    assert stats.output_bytes == os.path.getsize(output_path)
+    assert stats.downscaled_pages == []
+    assert "render" in stats.format()
+
+def test_main_stats_json(sample_pdf, tmp_path, capsys):
+    """Test that --stats-json writes the statistics of a single-file run."""
+    import json
+
+    stats_path = tmp_path / "stats.json"
+    output = str(tmp_path / "flat.pdf")
+    main([sample_pdf, "-o", output, "-b", "mupdf", "-d", "72", "--stats",
+          "--stats-json", str(stats_path)])
+    report = json.loads(stats_path.read_text())
+    assert report["pages"] == 1
+    assert report["output_bytes"] == os.path.getsize(output)
+    assert "Peak RSS" in capsys.readouterr().err or report["peak_rss_bytes"] is None
+
+def test_flatten_bytes(sample_pdf, tmp_path):
+    """Test flattening a PDF held in memory, without a file on either side."""
+    import fitz
+    from flatten_pdf import flatten_bytes
+
+    with open(sample_pdf, "rb") as f:
+        data = f.read()
+    for jobs in (1, 2):
+        result = flatten_bytes(
+            data, creation_date="2024-01-01", dpi=72, backend="mupdf", jobs=jobs
+        )
+        doc = fitz.open(stream=result, filetype="pdf")
+        assert doc.page_count == 1
+        assert doc.metadata["creationDate"].startswith("D:20240101")
+        assert not doc[0].get_text().strip()
+        doc.close()
+
+def test_main_stdin_stdout(sample_pdf, monkeypatch, capsysbinary):
+    """Test that "-" reads the input from stdin and writes the result to stdout."""
+    import fitz
+
+    with open(sample_pdf, "rb") as f:
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(f.read())))
+    main(["-", "-b", "mupdf", "-d", "72"])
+    doc = fitz.open(stream=capsysbinary.readouterr().out, filetype="pdf")
+    assert doc.page_count == 1
+    doc.close()
+
+@pytest.fixture
+def form_pdf(tmp_path):
+    """Create a 6-page PDF with a form field, an annotation and optional content."""
+    import fitz
+
+    pdf_path = str(tmp_path / "form.pdf")
+    doc = fitz.open()
+    for number in range(6):
+        doc.new_page().insert_text((100, 100), f"Page {number + 1}")
+    widget = fitz.Widget()
+    widget.field_name = "signature"
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.rect = fitz.Rect(100, 200, 300, 230)
+    widget.field_value = "Signed"
+    doc[1].add_widget(widget)
+    doc[3].add_text_annot((50, 50), "Note")
+    ocg = doc.add_ocg("Draft")
+    doc[4].insert_text((100, 300), "DRAFT", oc=ocg)
+    doc.save(pdf_path)
+    doc.close()
+    return pdf_path
+
+def test_parse_page_range():
+    """Test page range parsing, including open-ended ranges."""
+    assert parse_page_range("1-3, 7,9-", 10) == {1, 2, 3, 7, 9, 10}
+    assert parse_page_range("8-20", 10) == {8, 9, 10}
+    for text in ("0", "3-1", "a", "1,,2"):
+        with pytest.raises(ValueError):
+            parse_page_range(text, 10)
+
+def test_select_pages(form_pdf):
+    """Test that auto selection finds form fields, annotations and optional content."""
+    assert select_pages(form_pdf) is None
+    assert select_pages(form_pdf, "auto") == {2, 4, 5}
+    assert select_pages(form_pdf, "auto", "1") == {1, 2, 4, 5}
+    assert select_pages(form_pdf, pages=[6]) == {6}
+    with pytest.raises(ValueError):
+        select_pages(form_pdf, "some")
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_flatten_pdf_select_auto(form_pdf, tmp_path, jobs):
+    """Test that only pages needing it are rasterized and the rest are copied."""
+    import fitz
+
+    output = str(tmp_path / "output.pdf")
+    stats = flatten_pdf(form_pdf, output, dpi=72, backend="mupdf", jobs=jobs, select="auto")
+    assert stats.page_count == 3
+    assert stats.copied_pages == 3
+
+    doc = fitz.open(output)
+    assert doc.page_count == 6
+    for number, page in enumerate(doc, start=1):
+        rasterized = number in (2, 4, 5)
+        assert bool(page.get_images()) == rasterized
+        assert bool(page.get_text().strip()) != rasterized
+        assert page.first_widget is None and page.first_annot is None
+    assert "Page 3" in doc[2].get_text()
+    doc.close()
+
+def test_flatten_pdf_select_keeps_page_size(form_pdf, tmp_path):
+    """Test that rasterized pages at the default DPI keep the size of the pages around them."""
+    import fitz
+
+    output = str(tmp_path / "output.pdf")
+    flatten_pdf(form_pdf, output, backend="mupdf", select="auto")
+
+    with fitz.open(form_pdf) as source, fitz.open(output) as doc:
+        assert [page.rect for page in doc] == [page.rect for page in source]
+        # The signature page is still rendered at 200 DPI
+        image = doc.extract_image(doc[1].get_images()[0][0])
+        assert image["width"] == round(doc[1].rect.width * 200 / 72)
+
+def test_flatten_pdf_bake(form_pdf, tmp_path):
+    """Test that bake mode removes form fields and annotations but keeps the text."""
+    import fitz
+
+    output = str(tmp_path / "output.pdf")
+    main([form_pdf, "-o", output, "--mode", "bake", "-c", "2024-01-01"])
+
+    doc = fitz.open(output)
+    assert doc.page_count == 6
+    assert not doc.is_form_pdf
+    for number, page in enumerate(doc, start=1):
+        assert page.first_widget is None and page.first_annot is None
+        assert not page.get_images()
+        assert f"Page {number}" in page.get_text()
+    assert "Signed" in doc[1].get_text()
+    assert doc.metadata["creationDate"].startswith("D:20240101")
+    doc.close()
+
+def test_encode_jpeg_to_size():
+    """Test that the quality search picks the highest quality within the budget."""
+    from PIL import Image, ImageDraw
+
+    image = Image.radial_gradient("L").resize((400, 400)).convert("RGB")
+    ImageDraw.Draw(image).text((10, 10), "Target size", fill=(255, 0, 0))
+    large, high = encode_jpeg_to_size(image, 10 ** 9)
+    assert high == 95
+    data, quality = encode_jpeg_to_size(image, len(large) // 3)
+    assert len(data) <= len(large) // 3
+    assert 5 <= quality < 95
+    _, lowest = encode_jpeg_to_size(image, 1)
+    assert lowest == 5
+
+def test_flatten_pdf_target_page_kb(multipage_pdf, output_path):
+    """Test that every page fits the per-page target and reports its quality."""
+    stats = flatten_pdf(multipage_pdf, output_path, dpi=100, backend="mupdf", target_page_kb=8)
+    assert stats.pages
+    for page in stats.pages:
+        assert page["bytes"] <= 8 * 1024
+        assert 5 < page["quality"] <= 95
+    assert "quality" in stats.to_dict()["page_stats"][0]
+
+def test_flatten_pdf_max_output_mb_requires_all_pages(sample_pdf, output_path):
+    """Test that an output limit can't be combined with selective flattening."""
+    with pytest.raises(ValueError):
+        flatten_pdf(sample_pdf, output_path, backend="mupdf", select="auto", max_output_mb=1)
+
+def test_allocate_qualities():
+    """Test that the lowest quality is maximized before spending bytes elsewhere."""
+    dense = [(10, 100), (50, 300), (90, 900)]
+    blank = [(10, 10), (50, 20), (90, 40)]
+    bilevel = [(None, 50)]
+    ladders = [dense, blank, bilevel]
+    # Not even the lowest variants fit
+    assert allocate_qualities(ladders, 100) == [0, 0, 0]
+    # Quality 50 everywhere fits; the rest raises the blank page
+    assert allocate_qualities(ladders, 400) == [1, 2, 0]
+    assert allocate_qualities(ladders, 1000) == [2, 2, 0]
+
+def test_flatten_pdf_max_output_mb(multipage_pdf, output_path):
+    """Test that the output limit is met with per-page qualities from the ladder."""
+    unlimited = flatten_pdf(multipage_pdf, output_path, dpi=100, backend="mupdf")
+    # Mostly text, so even the lowest quality is not much smaller
+    limit_mb = unlimited.output_bytes * 0.95 / 1024 / 1024
+    stats = flatten_pdf(
+        multipage_pdf, output_path, dpi=100, backend="mupdf", jobs=2, max_output_mb=limit_mb
+    )
+    assert os.path.getsize(output_path) <= limit_mb * 1024 * 1024
+    qualities = [page["quality"] for page in stats.pages]
+    assert len(qualities) == 20
+    assert 5 <= min(qualities) < 50
+    assert sum(page["bytes"] for page in stats.pages) < stats.output_bytes
@@ -0,0 +1,51 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+
+# Seconds `import pdf_flattener` may add on top of bare interpreter start-up
+IMPORT_BUDGET = 0.15
+
+# Import this source tree as `pdf_flattener`, whatever the checkout is called
+IMPORT_PACKAGE = f"""
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location(
+    "pdf_flattener",
+    {str(PACKAGE_DIR / "__init__.py")!r},
+    submodule_search_locations=[{str(PACKAGE_DIR)!r}],
+)
+module = importlib.util.module_from_spec(spec)
+sys.modules["pdf_flattener"] = module
+spec.loader.exec_module(module)
+"""
+
+
+def run_python(code):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return time.perf_counter() - start, result.stdout
+
+
+def test_import_is_lazy():
+    """Test that importing the package loads no heavy dependencies or logging config."""
+    _, output = run_python(
+        IMPORT_PACKAGE
+        + """
+import logging
+print(callable(module.flatten_pdf))
+print(sorted(m for m in ("fitz", "pdf2image", "PIL", "multiprocessing") if m in sys.modules))
+print(len(logging.getLogger().handlers))
+"""
+    )
+    assert output.split("\n")[:3] == ["True", "[]", "0"]
+
+
+def test_import_time_budget():
+    """Test that importing the package stays within its time budget."""
+    baseline = min(run_python("import importlib.util")[0] for _ in range(3))
+    elapsed = min(run_python(IMPORT_PACKAGE)[0] for _ in range(3))
+    assert elapsed - baseline < IMPORT_BUDGET
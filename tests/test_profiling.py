@@ -0,0 +1,65 @@
+import json
+import pstats
+
+import fitz
+import pytest
+
+from pdf_flattener.cli import flatten_pdf, main
+from pdf_flattener.profiling import profile_cpu, profile_memory
+
+
+@pytest.fixture
+def sample_pdf(tmp_path):
+    """Create a one-page PDF."""
+    pdf_path = tmp_path / "test.pdf"
+    doc = fitz.open()
+    doc.new_page().insert_text((100, 100), "Test PDF")
+    doc.save(str(pdf_path))
+    doc.close()
+    return str(pdf_path)
+
+
+def test_profile_cpu_writes_speedscope(sample_pdf, tmp_path):
+    """Test that a CPU profile is written as a pstats dump and a speedscope file."""
+    profile_path = str(tmp_path / "run.prof")
+    speedscope_path = str(tmp_path / "run.speedscope.json")
+    with profile_cpu(profile_path, speedscope_path):
+        flatten_pdf(sample_pdf, str(tmp_path / "out.pdf"), dpi=72, backend="mupdf")
+
+    functions = {name for _, _, name in pstats.Stats(profile_path).stats}
+    assert "flatten_pdf" in functions
+
+    with open(speedscope_path) as f:
+        speedscope = json.load(f)
+    frames = speedscope["shared"]["frames"]
+    events = speedscope["profiles"][0]["events"]
+    assert "flatten_pdf" in {frame["name"] for frame in frames}
+    # Every opened frame is closed again, in order
+    stack = []
+    for event in events:
+        if event["type"] == "O":
+            stack.append(event["frame"])
+        else:
+            assert stack.pop() == event["frame"]
+    assert not stack
+
+
+def test_profile_memory_groups_by_stage(sample_pdf, tmp_path):
+    """Test that the memory report lists the pipeline stages."""
+    report_path = tmp_path / "memory.txt"
+    with profile_memory(str(report_path)) as profile:
+        flatten_pdf(sample_pdf, str(tmp_path / "out.pdf"), dpi=72, backend="mupdf")
+
+    assert {"prepare", "render", "assemble", "save"} <= set(profile.sites)
+    assert profile.peaks["render"] > 0
+    assert "render: peak" in report_path.read_text()
+
+
+def test_main_profile_option(sample_pdf, tmp_path):
+    """Test that --profile writes its files next to the given prefix."""
+    prefix = str(tmp_path / "profile")
+    output = str(tmp_path / "out.pdf")
+    main([sample_pdf, "-o", output, "-b", "mupdf", "-d", "72", "--profile", "cpu",
+          "--profile-output", prefix])
+    assert (tmp_path / "profile.prof").exists()
+    assert (tmp_path / "profile.speedscope.json").exists()
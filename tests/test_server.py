@@ -0,0 +1,143 @@
+import http.client
+import os
+import socket
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+import pytest
+
+from pdf_flattener.server import FlattenService, create_server
+
+
+@pytest.fixture
+def pdf_bytes():
+    """Create a small PDF in memory."""
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((100, 100), "Test PDF")
+    data = doc.write()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def service():
+    service = FlattenService(
+        workers=1, max_request_bytes=1024 * 1024, dpi=72, backend="mupdf"
+    )
+    yield service
+    service.close()
+
+
+@pytest.fixture
+def server_url(service):
+    """Run the HTTP server on a free port in a background thread."""
+    server = create_server(service, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, data):
+    request = urllib.request.Request(url, data=data, method="POST")
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return response.status, response.read()
+
+
+def test_health(server_url):
+    """Test the health check endpoint."""
+    with urllib.request.urlopen(f"{server_url}/health", timeout=10) as response:
+        assert response.status == 200
+
+
+def test_flatten_request(server_url, pdf_bytes):
+    """Test that a posted PDF comes back flattened."""
+    status, body = post(f"{server_url}/flatten?creation_date=2024-01-01", pdf_bytes)
+    assert status == 200
+
+    doc = fitz.open(stream=body, filetype="pdf")
+    assert doc.page_count == 1
+    assert doc[0].get_text() == ""
+    assert doc.metadata["creationDate"].startswith("D:20240101")
+    doc.close()
+
+
+def test_request_too_large(server_url):
+    """Test that bodies over the size limit are rejected before they are read."""
+    connection = http.client.HTTPConnection(server_url[len("http://"):], timeout=10)
+    connection.putrequest("POST", "/flatten")
+    connection.putheader("Content-Length", str(2 * 1024 * 1024))
+    connection.endheaders()
+    assert connection.getresponse().status == 413
+    connection.close()
+
+
+def test_negative_content_length(server_url):
+    """Test that a negative Content-Length is rejected instead of reading to EOF."""
+    connection = http.client.HTTPConnection(server_url[len("http://"):], timeout=10)
+    connection.putrequest("POST", "/flatten")
+    connection.putheader("Content-Length", "-1")
+    connection.endheaders()
+    assert connection.getresponse().status == 400
+    connection.close()
+
+
+def test_stalled_upload_holds_no_slot(service, pdf_bytes):
+    """Test that a client sending less than it announced neither blocks others nor stays."""
+    server = create_server(service, "127.0.0.1", 0, timeout=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        stalled = socket.create_connection(server.server_address, timeout=10)
+        stalled.sendall(b"POST /flatten HTTP/1.1\r\nContent-Length: 1000\r\n\r\npartial")
+        # The only slot is still free for other requests
+        assert post(f"{url}/flatten", pdf_bytes)[0] == 200
+        # and the stalled connection is dropped after the timeout
+        assert stalled.recv(1024) == b""
+        stalled.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_worker_crash_replaces_pool(service, server_url, pdf_bytes):
+    """Test that requests succeed again after a worker process died."""
+    with pytest.raises(BrokenProcessPool):
+        service.executor.submit(os._exit, 1).result()
+
+    assert post(f"{server_url}/flatten", pdf_bytes)[0] == 200
+    assert post(f"{server_url}/flatten", pdf_bytes)[0] == 200
+
+
+def test_invalid_pdf(server_url):
+    """Test that a broken PDF is reported to the client."""
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        post(f"{server_url}/flatten", b"not a pdf")
+    assert excinfo.value.code == 422
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix sockets not available")
+def test_unix_socket(service, pdf_bytes, tmp_path):
+    """Test serving over a Unix domain socket."""
+    socket_path = str(tmp_path / "flatten.sock")
+    server = create_server(service, socket_path=socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection("localhost", timeout=60)
+        connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.sock.connect(socket_path)
+        connection.request("POST", "/flatten", body=pdf_bytes)
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.read().startswith(b"%PDF")
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()